@@ -1,7 +1,65 @@
-from xml.etree import ElementTree
-
-from config import CONSUMER_KEY
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from requests import RequestException
+
+import mirror
+from breaker import CircuitOpen
+from cache import TTLCache
+from config import (BOOK_PAGES_CACHE_SIZE, BOOK_PAGES_CACHE_TTL,
+                    BOOKS_CACHE_MAX_BYTES, BOOKS_CACHE_SIZE, BOOKS_CACHE_TTL,
+                    BULK_BACKOFF, BULK_RETRIES, BULK_WORKERS, CACHE_STALE_TTL,
+                    CONSUMER_KEY, LIBRARY_CACHE_SIZE, LIBRARY_CACHE_TTL,
+                    SEARCH_CACHE_MAX_BYTES, SEARCH_CACHE_SIZE,
+                    SEARCH_CACHE_TTL, SHELVES_CACHE_SIZE, SHELVES_CACHE_TTL)
+from flight import SingleFlight
+from library import EXCLUSIVE_SHELVES, LibraryIndex
+from metrics import api_errors
+from models import Book, load_books, load_shelves
+from parsers import parser, response_source
+from prefetch import prefetcher, revalidator
+from ratelimit import PREFETCH, priority
 from service import goodreads_service
+from tiered import tiered
+
+# inline search page size, smaller chat pages are sliced out of it
+SEARCH_WINDOW = 20
+
+# the caches below keep expired entries for CACHE_STALE_TTL more seconds, to
+# be served while goodreads.com is failing; shelves, books and searches are
+# also written to Postgres so they survive restarts
+shelves_cache = tiered(TTLCache(maxsize=SHELVES_CACHE_SIZE, ttl=SHELVES_CACHE_TTL,
+                                stale_ttl=CACHE_STALE_TTL), "shelves:2", load_shelves)
+shelf_state_cache = TTLCache(maxsize=SHELVES_CACHE_SIZE, ttl=SHELVES_CACHE_TTL)
+# short-lived pages of /review/list, mostly filled by the prefetcher
+book_pages_cache = TTLCache(maxsize=BOOK_PAGES_CACHE_SIZE, ttl=BOOK_PAGES_CACHE_TTL,
+                            stale_ttl=CACHE_STALE_TTL)
+# book metadata is the same for everyone and rarely changes
+books_cache = tiered(TTLCache(maxsize=BOOKS_CACHE_SIZE, ttl=BOOKS_CACHE_TTL,
+                              max_bytes=BOOKS_CACHE_MAX_BYTES, stale_ttl=CACHE_STALE_TTL),
+                     "books:2", Book.load)
+# search results only depend on the app key, so they are shared by all users
+search_cache = tiered(TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL,
+                               max_bytes=SEARCH_CACHE_MAX_BYTES, stale_ttl=CACHE_STALE_TTL),
+                      "search:2", load_books)
+search_flight = SingleFlight()
+# per-user search indexes over the books on their shelves
+libraries = TTLCache(maxsize=LIBRARY_CACHE_SIZE, ttl=LIBRARY_CACHE_TTL)
+
+
+# goodreads.com failing, rather than answering with an error
+UPSTREAM_ERRORS = (CircuitOpen, RequestException)
+
+_local = threading.local()
+
+
+def served_stale():
+    # whether the last GoodreadsAPI call on this thread answered with cached
+    # data past its TTL
+    return getattr(_local, 'stale', False)
 
 
 class AuthError(Exception):
@@ -16,11 +74,13 @@ def session_decorator(func):
     def wrapper(self, *args, **kwargs):
         session = goodreads_service.get_db_tokens_session(args[0])
         if not session:
+            api_errors.labels("AuthError").inc()
             raise AuthError("""Попробуйте авторизоваться через /authorize, """
                             """либо используйте /logout и /authorize для повторной авторизации, """
                             """в случае проблем с доступом""")
 
         kwargs['session'] = session
+        _local.stale = False
         return func(self, *args[1:], **kwargs)
 
     return wrapper
@@ -30,62 +90,163 @@ class GoodreadsAPI():
     def me(self, session=None):
         response = session.get('/api/auth_user')
 
-        root = ElementTree.fromstring(response.content)
-        goodreads_id = root.find('user').attrib['id']
-
-        return goodreads_id
+        return parser.auth_user(response.content)
 
     @session_decorator
     def get_search_books(self, search_query, page=1, per_page=5, session=None):
+        search_query = " ".join(search_query.lower().split())
+
+        if per_page < SEARCH_WINDOW and SEARCH_WINDOW % per_page == 0:
+            start = (page - 1) * per_page
+            window = self._search(session, search_query,
+                                  start // SEARCH_WINDOW + 1, SEARCH_WINDOW)
+            start %= SEARCH_WINDOW
+
+            return window[start:start + per_page]
+
+        return self._search(session, search_query, page, per_page)
+
+    def _search(self, session, search_query, page, per_page):
+        key = (search_query, page, per_page)
+        books = search_cache.get(key)
+        if books is not None:
+            prefetcher.hit(key)
+            return books
+
+        try:
+            # identical searches already in flight share one upstream call
+            return search_flight.do(key, self._fetch_search, session, key)
+        except UPSTREAM_ERRORS:
+            books = self._stale(search_cache, key, self._fetch_search, session, key)
+            if books is None:
+                raise
+            return books
+
+    def _fetch_search(self, session, key):
+        search_query, page, per_page = key
         params = {
             "q": search_query,
             "key": CONSUMER_KEY,
             "page": page,
             "per_page": per_page,
         }
-        response = session.get("/search/index.xml",
-                               params=params)
-
-        root = ElementTree.fromstring(response.content)
-
-        books = []
-        book_fields = ['title', 'id', 'image_url']
-        for entry in root.iter('best_book'):
-            book = {field: entry.find(field).text for field in book_fields}
-            authors = [auth.find('name').text for auth in entry.iter('author')]
-            book['authors'] = authors
+        with session.get("/search/index.xml",
+                         params=params, stream=True) as response:
+            books = parser.search_books(response_source(response))
 
-            books.append(book)
+        search_cache.set(key, books)
+        prefetcher.filled(key)
 
         return books
 
+    def _stale(self, cache, key, refresh, *args):
+        # last known good value while goodreads.com is failing, None if
+        # there is none; refresh(*args) brings it up to date in the background
+        value = cache.get_stale(key)
+        if value is not None:
+            _local.stale = True
+            revalidator.schedule((refresh.__name__, key), refresh, *args)
+
+        return value
+
+    def _library(self, user_id):
+        index = libraries.get(user_id)
+        if index is not None and index.complete:
+            return index
+
+        if mirror.is_ready(user_id):
+            # replaces the partial index built from the pages seen so far
+            index = LibraryIndex(complete=True)
+            for book, shelves in mirror.library(user_id):
+                for shelf in shelves:
+                    index.add(book, shelf)
+            libraries.set(user_id, index)
+        elif index is None:
+            index = LibraryIndex()
+            libraries.set(user_id, index)
+
+        return index
+
+    def search_library(self, user_id, search_query, limit=5):
+        # the user's own books matching the query, no upstream call
+        return self._library(user_id).search(search_query, limit)
+
+    def forget_user(self, user_id):
+        goodreads_service.invalidate_session(user_id)
+        shelves_cache.pop(user_id)
+        shelf_state_cache.pop(user_id)
+        self._forget_book_pages(user_id)
+        libraries.pop(user_id)
+        mirror.forget(user_id)
+
+    def _forget_book_pages(self, user_id):
+        book_pages_cache.discard(lambda key: key[0] == user_id)
+
+    def _update_shelf_counts(self, user_id, changes):
+        shelves = shelves_cache.get(user_id)
+        if shelves is None:
+            return
+
+        # cached lists are shared with readers, so build a new one
+        updated = []
+        for shelf in shelves:
+            delta = changes.get(shelf.name)
+            if delta:
+                shelf = shelf._replace(book_count=max(shelf.book_count + delta, 0))
+            updated.append(shelf)
+
+        shelves_cache.set(user_id, updated)
+
     @session_decorator
     def get_shelves(self, page=1, per_page=5, session=None):
-        goodreads_id = self.me(session=session)
-
+        shelves = shelves_cache.get(session.user_id)
+        if shelves is not None:
+            return shelves
+
+        try:
+            return self._fetch_shelves(session)
+        except UPSTREAM_ERRORS:
+            shelves = self._stale(shelves_cache, session.user_id, self._fetch_shelves, session)
+            if shelves is None:
+                raise
+            return shelves
+
+    def _fetch_shelves(self, session):
         params = {
             "key": CONSUMER_KEY,
-            "user_id": goodreads_id,
+            "user_id": self._goodreads_id(session),
             "format": "xml",
         }
-        response = session.get("/shelf/list.xml",
-                               params=params)
-
-        root = ElementTree.fromstring(response.content)
-
-        shelf_fields = frozenset(['book_count', 'name'])
-        shelves = []
-
-        for shelf in root.iter('user_shelf'):
-            shelf = {field: shelf.find(field).text for field in shelf_fields}
-            shelf['show_name'] = " ".join(shelf['name'].split("-")).title()
+        with session.get("/shelf/list.xml",
+                         params=params, stream=True) as response:
+            shelves = parser.shelves(response_source(response))
 
-            shelves.append(shelf)
+        shelves = shelves[::-1]
+        shelves_cache.set(session.user_id, shelves)
 
-        return shelves[::-1]
+        return shelves
 
     @session_decorator
     def get_books(self, page=1, per_page=5, shelf="etc", session=None):
+        if mirror.is_ready(session.user_id):
+            return mirror.get_books(session.user_id, shelf, page, per_page)
+
+        key = (session.user_id, shelf, page, per_page)
+        books = book_pages_cache.get(key)
+        if books is not None:
+            prefetcher.hit(key)
+            return books
+
+        try:
+            return self._fetch_books(session, key)
+        except UPSTREAM_ERRORS:
+            books = self._stale(book_pages_cache, key, self._fetch_books, session, key)
+            if books is None:
+                raise
+            return books
+
+    def _fetch_books(self, session, key):
+        _, shelf, page, per_page = key
         params = {
             "v": 2,
             "key": CONSUMER_KEY,
@@ -94,77 +255,122 @@ class GoodreadsAPI():
             "shelf": shelf,
             "per_page": per_page,
         }
-        response = session.get("/review/list",
-                               params=params)
-
-        root = ElementTree.fromstring(response.content)
-
-        book_fields = frozenset(['id', 'title', 'publication_year', 'link'])
-        books = []
-        for entry in root.iter('book'):
-            book = {field: entry.find(field).text for field in book_fields}
+        with session.get("/review/list",
+                         params=params, stream=True) as response:
+            books = parser.books(response_source(response))
 
-            authors = [auth.find('name').text for auth in entry.iter('author')]
-            book['authors'] = authors
+        library = self._library(session.user_id)
+        for book in books:
+            library.add(book, shelf)
 
-            books.append(book)
+        book_pages_cache.set(key, books)
+        prefetcher.filled(key)
 
         return books
 
     @session_decorator
-    def get_book(self, book_id, session=None):
+    def get_reviews(self, page=1, per_page=200, shelf=None,
+                    sort="date_updated", order="d", session=None):
+        # every shelved book, most recently changed first by default, for
+        # the mirror and exports
         params = {
+            "v": 2,
             "key": CONSUMER_KEY,
+            "id": self._goodreads_id(session),
             "format": "xml",
+            "sort": sort,
+            "order": order,
+            "page": page,
+            "per_page": per_page,
         }
-        response = session.get(f'/book/show/{book_id}.xml',
-                               params=params)
-        root = ElementTree.fromstring(response.content)
+        if shelf:
+            params["shelf"] = shelf
+        with session.get("/review/list",
+                         params=params, stream=True) as response:
+            return parser.reviews(response_source(response))
 
-        book_xml = root.find('book')
+    def _goodreads_id(self, session):
+        if not session.goodreads_id:
+            session.goodreads_id = self.me(session=session)
 
-        book_fields = [
-            'id', 'title', 'description',
-            'image_url', 'small_image_url', 'link'
-        ]
-        book = {field: book_xml.find(field).text for field in book_fields}
+        return session.goodreads_id
 
-        authors = book_xml.find("authors")
-        book['authors'] = [a.find('name').text for a in authors.iter('author')]
+    def _shelf_state(self, user_id):
+        # book_id -> shelf name, '' when the book is on no shelf
+        state = shelf_state_cache.get(user_id)
+        if state is None:
+            state = {}
+            shelf_state_cache.set(user_id, state)
 
-        shelf_xml = root.find("./book/my_review/shelves/shelf")
+        return state
 
-        response = {
-            "title": book["title"],
-            "authors": book["authors"],
-            "description": book.get("description"),
-            "link": book["link"],
-            "image": book['image_url'] or book['small_image_url']
+    @session_decorator
+    def get_book(self, book_id, session=None):
+        book_id = str(book_id)
+        state = self._shelf_state(session.user_id)
+
+        book = books_cache.get(book_id)
+        if book is None:
+            try:
+                book, shelf = self._refresh_book(session, book_id)
+            except UPSTREAM_ERRORS:
+                book = self._stale(books_cache, book_id, self._refresh_book, session, book_id)
+                if book is None:
+                    raise
+                shelf = state.get(book_id)
+        else:
+            shelf = state.get(book_id)
+            if shelf is None:
+                try:
+                    shelf = self._fetch_book_shelf(session, book_id)
+                    state[book_id] = shelf or ''
+                except (*UPSTREAM_ERRORS, ApiError):
+                    # the book without its shelf beats no answer
+                    _local.stale = True
+
+        # the user's shelf goes with the shared metadata in a copy
+        return book._replace(shelves=(shelf,) if shelf else ())
+
+    def _refresh_book(self, session, book_id):
+        book, shelf = self._fetch_book(session, book_id)
+        books_cache.set(book_id, book)
+        self._shelf_state(session.user_id)[book_id] = shelf or ''
+
+        return book, shelf
+
+    def _fetch_book(self, session, book_id):
+        params = {
+            "key": CONSUMER_KEY,
+            "format": "xml",
         }
-        if shelf_xml is not None:
-            response['shelf'] = shelf_xml.attrib['name']
-
-        return response
+        response = session.get(f'/book/show/{book_id}.xml',
+                               params=params)
 
-    @session_decorator
-    def add_to_shelf(self, shelf, book_id, remove=False, session=None):
-        # can also remove book from shelf (tnx for greads developers)
+        # (static metadata, this user's shelf)
+        return parser.book(response.content)
 
-        data = {
-            'name': shelf,
-            'book_id': book_id,
+    def _fetch_book_shelf(self, session, book_id):
+        params = {
+            "key": CONSUMER_KEY,
+            "user_id": self._goodreads_id(session),
+            "book_id": book_id,
+            "format": "xml",
         }
-        if remove:
-            data['name'] = 'to-read'
-            response = session.post("shelf/add_to_shelf.xml",
-                                    data=data)
-            data['a'] = 'remove'
+        response = session.get("/review/show_by_user_and_book.xml",
+                               params=params)
+        if response.status_code == 404:
+            # no review means the book is not on any of the user's shelves
+            return None
+        if response.status_code != 200:
+            api_errors.labels("ApiError").inc()
+            raise ApiError(f"Не удалось узнать полку книги! status: {response.status_code}")
 
-        response = session.post("shelf/add_to_shelf",
-                                data=data)
+        return parser.review_shelf(response.content)
 
-        if response.status_code not in (200, 201):
-            raise ApiError(f"Ошибка добавления! status: {response.status_code} data: {data}")
+    @session_decorator
+    def add_to_shelf(self, shelf, book_id, remove=False, session=None):
+        self._post_to_shelf(session, shelf, book_id, remove=remove)
+        self._shelved(session.user_id, shelf, [book_id], remove=remove)
 
         message = "Книга добавлена на полку!"
         if remove:
@@ -172,5 +378,161 @@ class GoodreadsAPI():
 
         return message
 
+    @session_decorator
+    def bulk_add_to_shelf(self, shelf, book_ids, remove=False, source=None, session=None):
+        # Writes run BULK_WORKERS at a time, each retried with backoff, and
+        # the caches are fixed up once at the end. Returns the ids written
+        # and {book_id: error} for the rest. With `source` the books are
+        # moved off it as well. The writes queue behind everyone's
+        # interactive traffic, like exports.
+        # adding to an exclusive shelf moves a book off the other ones, off
+        # a non-exclusive source it has to be removed; off an exclusive one
+        # it can't be without leaving the library, so it stays there
+        move_off = source is not None and source != shelf and source not in EXCLUSIVE_SHELVES
+        added, moved_off = [], []
+
+        def write(book_id):
+            with priority(PREFETCH):
+                self._post_to_shelf(session, shelf, book_id, remove=remove,
+                                    retries=BULK_RETRIES)
+                added.append(book_id)
+                if move_off:
+                    self._post_to_shelf(session, source, book_id, remove=True,
+                                        retries=BULK_RETRIES)
+                    moved_off.append(book_id)
+
+        done, failed = [], {}
+        with ThreadPoolExecutor(max_workers=BULK_WORKERS,
+                                thread_name_prefix='bulk') as executor:
+            futures = {executor.submit(write, book_id): book_id for book_id in book_ids}
+            for future in as_completed(futures):
+                book_id = futures[future]
+                try:
+                    future.result()
+                except Exception as ex:
+                    failed[book_id] = str(ex)
+                else:
+                    done.append(book_id)
+
+        if moved_off:
+            self._shelved(session.user_id, source, moved_off, remove=True)
+        if added:
+            self._shelved(session.user_id, shelf, added, remove=remove)
+
+        return done, failed
+
+    def shelf_book_ids(self, user_id, shelf, per_page=200, limit=None):
+        # stops listing once there are more than `limit`
+        book_ids = []
+        page = 1
+        while True:
+            books = self.get_books(user_id, page, per_page, shelf)
+            book_ids.extend(book.id for book in books)
+            if len(books) < per_page or (limit is not None and len(book_ids) > limit):
+                return book_ids
+            page += 1
+
+    def _post_to_shelf(self, session, shelf, book_id, remove=False, retries=0):
+        # can also remove book from shelf (tnx for greads developers)
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(BULK_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+            data = {
+                'name': shelf,
+                'book_id': book_id,
+            }
+            try:
+                if remove and shelf in EXCLUSIVE_SHELVES:
+                    data['name'] = 'to-read'
+                    response = session.post("shelf/add_to_shelf.xml",
+                                            data=data)
+                if remove:
+                    data['a'] = 'remove'
+
+                response = session.post("shelf/add_to_shelf",
+                                        data=data)
+            except RequestException:
+                if attempt == retries:
+                    raise
+                continue
+
+            if response.status_code in (200, 201):
+                return
+            # only rate limiting and server errors are worth another try
+            if response.status_code != 429 and response.status_code < 500:
+                break
+
+        api_errors.labels("ApiError").inc()
+        raise ApiError(f"Ошибка добавления! status: {response.status_code} data: {data}")
+
+    def _shelved(self, user_id, shelf, book_ids, remove=False):
+        # brings the caches, the library index and the mirror in line with
+        # books just written to (or removed from) `shelf`
+        state = self._shelf_state(user_id)
+        changes = defaultdict(int)
+        unknown = False
+        exclusive = shelf in EXCLUSIVE_SHELVES
+        if remove and exclusive:
+            # the complete index knows every shelf the books are on, read
+            # before the mirror drops them
+            library = self._library(user_id)
+        else:
+            library = libraries.get(user_id)
+        for book_id in book_ids:
+            current_shelf = state.get(str(book_id))
+            if remove and exclusive:
+                # off its exclusive shelf the book leaves the library, and
+                # every other shelf it was on with it
+                state[str(book_id)] = ''
+                if not library.complete:
+                    unknown = True
+                changes[shelf] -= 1
+                for other in library.shelves_of(book_id):
+                    if other != shelf:
+                        changes[other] -= 1
+                continue
+            if remove:
+                changes[shelf] -= 1
+                if current_shelf == shelf:
+                    state[str(book_id)] = ''
+                continue
+
+            if current_shelf is None:
+                unknown = True
+            elif current_shelf != shelf:
+                # only read, currently-reading and to-read exclude each
+                # other, any other shelf is added next to the current one
+                if exclusive and current_shelf in EXCLUSIVE_SHELVES:
+                    changes[current_shelf] -= 1
+                changes[shelf] += 1
+
+            # the state keeps the exclusive shelf, the one the keyboard marks
+            if exclusive or current_shelf not in EXCLUSIVE_SHELVES:
+                state[str(book_id)] = shelf
+
+        if unknown:
+            # previous shelves are unknown, the counts can't be fixed up locally
+            shelves_cache.pop(user_id)
+        else:
+            self._update_shelf_counts(user_id, changes)
+        self._forget_book_pages(user_id)
+
+        ready = mirror.is_ready(user_id)
+        stale = False
+        for book_id in book_ids:
+            book = books_cache.get(str(book_id))
+            if library is not None:
+                if remove:
+                    library.remove(book_id, shelf)
+                elif book is not None:
+                    library.add(book._replace(id=str(book_id)), shelf)
+
+            if ready and not mirror.move_book(user_id, book, book_id, shelf, remove=remove):
+                stale = True
+
+        if stale:
+            mirror.request_sync(user_id)
+
 
 goodreads_api = GoodreadsAPI()
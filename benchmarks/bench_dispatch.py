@@ -0,0 +1,139 @@
+"""Wall time for a burst of /book_<id> updates from different users through
+the real bot.py handlers and GoodreadsAPI, against the fake goodreads.com
+with --latency per response: handlers run on the dispatcher thread vs. on
+the worker pool. Every update asks for a book that isn't cached, so each
+one is a goodreads.com round trip. Uses the Postgres from DATABASE_URL for
+the tokens of a few throwaway users. The upstream rate limits are off
+unless set in the environment, they would cap both runs alike.
+
+Upstream concurrency is capped at min(DISPATCHER_WORKERS, HTTP_POOL_MAXSIZE)
+requests in flight, 20 by default. Exits with an error when the fake sees
+more than that, or when the worker pool doesn't reach it.
+
+    python -m benchmarks.bench_dispatch --updates 200 --users 50 --latency 0.2
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+from queue import Queue
+
+from benchmarks.bench_handlers import (FIRST_USER_ID, add_users, remove_users,
+                                       reset_caches)
+from benchmarks.fakes import FakeBot, FakeGoodreads, Updates
+
+
+class InFlight():
+    # concurrent requests seen by the fake goodreads.com
+
+    def __init__(self, fake):
+        self._lock = threading.Lock()
+        self._handle = fake._handle
+        self.active = 0
+        self.peak = 0
+        fake._handle = self.handle
+
+    def handle(self, handler, method):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            self._handle(handler, method)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def run(run_async, updates, user_ids, first_book, count, workers):
+    from telegram.ext import Dispatcher
+
+    import bot
+
+    done = threading.Semaphore(0)
+
+    def finished(callback):
+        def wrapper(update, context):
+            try:
+                return callback(update, context)
+            finally:
+                done.release()
+
+        wrapper.__name__ = callback.__name__
+        return wrapper
+
+    dispatcher = Dispatcher(updates.bot, Queue(), workers=workers)
+    bot.add_handlers(dispatcher)
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            handler.callback = finished(handler.callback)
+            handler.run_async = run_async
+
+    thread = threading.Thread(target=dispatcher.start, daemon=True)
+    thread.start()
+
+    started = time.monotonic()
+    for n in range(count):
+        user_id = user_ids[n % len(user_ids)]
+        dispatcher.update_queue.put(updates.message(user_id, f"/book_{first_book + n}"))
+    for _ in range(count):
+        done.acquire()
+    elapsed = time.monotonic() - started
+
+    dispatcher.stop()
+
+    return elapsed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--updates", type=int, default=200)
+    arg_parser.add_argument("--users", type=int, default=50)
+    arg_parser.add_argument("--latency", type=float, default=0.2)
+    args = arg_parser.parse_args()
+
+    fake = FakeGoodreads(latency=args.latency).start()
+    in_flight = InFlight(fake)
+    os.environ["GOODREADS_URL"] = fake.url
+    os.environ.setdefault("UPSTREAM_RATE", "0")
+    os.environ.setdefault("UPSTREAM_USER_RATE", "0")
+
+    # imported late, config is read from the environment at import
+    from config import DISPATCHER_WORKERS, HTTP_POOL_MAXSIZE
+    from postgres import pool
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    updates = Updates(FakeBot())
+    user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+    ceiling = min(DISPATCHER_WORKERS, HTTP_POOL_MAXSIZE)
+    errors = []
+    add_users(pool, user_ids)
+    try:
+        print(f"in-flight ceiling: min(DISPATCHER_WORKERS={DISPATCHER_WORKERS}, "
+              f"HTTP_POOL_MAXSIZE={HTTP_POOL_MAXSIZE}) = {ceiling}")
+        for index, (name, run_async) in enumerate((("dispatcher thread", False), ("worker pool", True))):
+            reset_caches()
+            in_flight.peak = 0
+            elapsed = run(run_async, updates, user_ids, 1 + index * args.updates, args.updates,
+                          DISPATCHER_WORKERS)
+            print(f"{name:>17}: {args.updates} updates in {elapsed:.2f}s "
+                  f"({args.updates / elapsed:.1f} updates/s), "
+                  f"{in_flight.peak} goodreads.com requests in flight at most")
+
+            expected = min(ceiling, args.updates) if run_async else 1
+            if in_flight.peak != expected:
+                errors.append(f"{name}: {in_flight.peak} requests in flight, expected {expected}")
+    finally:
+        import bot
+        for user_id in user_ids:
+            bot.goodreads_api.forget_user(user_id)
+        remove_users(pool, user_ids)
+        fake.stop()
+
+    if errors:
+        raise SystemExit("\n".join(errors))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""Per-handler latency, goodreads.com calls per user action and parse time,
+with goodreads.com and Telegram replaced by the local fakes. Uses the
+Postgres from DATABASE_URL (docker-compose up db) for the tokens of a few
+throwaway users. The upstream rate limits still apply, set
+UPSTREAM_USER_RATE=0 to measure without them.
+
+    python -m benchmarks.bench_handlers --users 20 --latency 0.05 --save
+    python -m benchmarks.bench_handlers --cold
+    python -m benchmarks.bench_handlers --compare results/a.json results/b.json
+    python -m benchmarks.bench_handlers --check
+"""
+import argparse
+import logging
+import os
+import time
+import timeit
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+
+from benchmarks import report
+from benchmarks.fakes import FakeBot, FakeGoodreads, Updates
+
+# ids no Telegram user can have
+FIRST_USER_ID = 2000000000
+SEARCHES = ("harry potter", "the hobbit", "war and peace", "dune", "anna karenina")
+BOOK_ID = 3
+
+
+def actions(updates, user_id, index):
+    # (name, handler name in bot.py, update) for one user's session
+    query = SEARCHES[index % len(SEARCHES)]
+    return (
+        ("search", "search_books", updates.message(user_id, query)),
+        ("search_next", "search_books", updates.callback(user_id, f"search_books 2 {query}")),
+        ("inline", "inlinequery", updates.inline(user_id, query)),
+        ("shelves", "shelves", updates.command(user_id, "/shelves")),
+        ("books", "books", updates.callback(user_id, "books_to-read_1")),
+        ("books_next", "books", updates.callback(user_id, "books_to-read_2")),
+        ("book", "book", updates.message(user_id, f"/book_{BOOK_ID}")),
+        ("add_to_shelf", "add_to_shelf", updates.callback(user_id, f"add_to_shelf read {BOOK_ID}")),
+        ("remove", "add_to_shelf", updates.callback(user_id, f"rm_from_shelf read {BOOK_ID}")),
+    )
+
+
+def add_users(pool, user_ids):
+    with pool.cursor() as cur:
+        for user_id in user_ids:
+            cur.execute("INSERT INTO tokens (id, access_token, access_token_secret, goodreads_id) "
+                        "VALUES (%s, 'bench', 'bench', 12345678) "
+                        "ON CONFLICT (id) DO UPDATE "
+                        "SET (access_token, access_token_secret) = ('bench', 'bench')", (user_id,))
+
+
+def remove_users(pool, user_ids):
+    with pool.cursor() as cur:
+        cur.execute("DELETE FROM tokens WHERE id = ANY(%s)", (list(user_ids),))
+
+
+def reset_caches():
+    import api
+    import cursors
+    import render
+    import service
+
+    for cache in (api.shelves_cache, api.shelf_state_cache, api.book_pages_cache,
+                  api.books_cache, api.search_cache, api.libraries, service.sessions_cache,
+                  cursors.cursors):
+        cache.clear()
+    render.clear()
+
+
+def wait_for_prefetch(prefetcher):
+    while True:
+        stats = prefetcher.stats()
+        if not stats["queued"] and not stats["running"]:
+            return
+        time.sleep(0.005)
+
+
+def parse_times(parser, number):
+    from benchmarks import bench_parse
+
+    # microseconds per response
+    times = {}
+    for name, method, tag in bench_parse.CASES:
+        content = bench_parse.load(name)
+        seconds = timeit.timeit(lambda: bench_parse.parse(parser, method, content), number=number)
+        times[name] = seconds / number * 1e6
+
+    return times
+
+
+def run(args):
+    fake = FakeGoodreads(latency=args.latency).start()
+    os.environ["GOODREADS_URL"] = fake.url
+    os.environ.setdefault("INLINE_DEBOUNCE", "0")
+
+    # imported late, config is read from the environment at import, so
+    # nothing imported above may pull in config
+    import bot
+    from parsers import parser
+    from postgres import pool
+    from prefetch import prefetcher
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    fake_bot = FakeBot()
+    context = SimpleNamespace(bot=fake_bot)
+    updates = Updates(fake_bot)
+
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + args.users)
+    add_users(pool, user_ids)
+
+    latencies = defaultdict(list)
+    upstream = defaultdict(Counter)
+    prefetched = Counter()
+    try:
+        for index, user_id in enumerate(user_ids):
+            for name, handler, update in actions(updates, user_id, index):
+                if args.cold:
+                    reset_caches()
+
+                before = fake.calls()
+                started = time.perf_counter()
+                getattr(bot, handler)(update, context)
+                latencies[name].append(time.perf_counter() - started)
+                during = fake.calls()
+
+                wait_for_prefetch(prefetcher)
+                upstream[name].update(during - before)
+                prefetched[name] += sum((fake.calls() - during).values())
+    finally:
+        for user_id in user_ids:
+            bot.goodreads_api.forget_user(user_id)
+        remove_users(pool, user_ids)
+        fake.stop()
+
+    return {
+        "config": {
+            "users": args.users,
+            "latency": args.latency,
+            "cold": args.cold,
+            "parser": parser.name,
+        },
+        "handlers": {name: report.summary(values) for name, values in latencies.items()},
+        "upstream_per_action": {
+            name: {
+                "calls": sum(calls.values()) / args.users,
+                "prefetch": prefetched[name] / args.users,
+                "endpoints": {endpoint: n / args.users for endpoint, n in calls.items()},
+            }
+            for name, calls in upstream.items()
+        },
+        "bot_calls": dict(fake_bot.sent),
+        "parse_us": parse_times(parser, args.parse_number),
+    }
+
+
+def check(args):
+    # the caches after removing a book from an exclusive shelf: the book
+    # leaves the library, every shelf it was on loses it
+    fake = FakeGoodreads(latency=args.latency).start()
+    os.environ["GOODREADS_URL"] = fake.url
+
+    import api
+    from library import LibraryIndex
+    from models import Author, Book, Shelf
+    from postgres import pool
+
+    user_id = FIRST_USER_ID
+    book = Book(str(BOOK_ID), "Check", (Author("Author"),))
+    counts = {"read": 10, "favorites": 26, "to-read": 5}
+    failures = []
+    add_users(pool, [user_id])
+    try:
+        for complete in (True, False):
+            reset_caches()
+            api.shelves_cache.set(user_id, [Shelf(name, count, name) for name, count in counts.items()])
+            api.shelf_state_cache.set(user_id, {book.id: "read"})
+            index = LibraryIndex(complete=complete)
+            index.add(book, "read")
+            index.add(book, "favorites")
+            api.libraries.set(user_id, index)
+
+            api.goodreads_api.add_to_shelf(user_id, "read", BOOK_ID, remove=True)
+
+            shelves = api.shelves_cache.get(user_id)
+            if complete:
+                expected = {"read": 9, "favorites": 25, "to-read": 5}
+                got = {shelf.name: shelf.book_count for shelf in shelves} if shelves else None
+            else:
+                # the index only knows the pages seen, the counts are refetched
+                expected, got = None, shelves
+            if got != expected:
+                failures.append(f"complete={complete}: counts {got}, expected {expected}")
+            if index.shelves_of(BOOK_ID):
+                failures.append(f"complete={complete}: still indexed on {index.shelves_of(BOOK_ID)}")
+            if api.shelf_state_cache.get(user_id).get(book.id) != "":
+                failures.append(f"complete={complete}: state {api.shelf_state_cache.get(user_id)}")
+    finally:
+        api.goodreads_api.forget_user(user_id)
+        remove_users(pool, [user_id])
+        fake.stop()
+
+    for failure in failures:
+        print(failure)
+    print("ok" if not failures else f"{len(failures)} failed")
+
+    return not failures
+
+
+def print_results(results):
+    print(f"{'action':<14}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'calls':>8}{'prefetch':>10}")
+    for name, latency in results["handlers"].items():
+        calls = results["upstream_per_action"][name]
+        print(f"{name:<14}{latency['p50']:>9.1f}{latency['p90']:>9.1f}{latency['p99']:>9.1f}"
+              f"{calls['calls']:>8.2f}{calls['prefetch']:>10.2f}")
+
+    print()
+    print(f"{'fixture':<18}{'us/parse':>10}")
+    for name, us in results["parse_us"].items():
+        print(f"{name:<18}{us:>10.1f}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--users", type=int, default=20)
+    arg_parser.add_argument("--latency", type=float, default=0.05,
+                            help="seconds the fake goodreads.com takes per response")
+    arg_parser.add_argument("--cold", action="store_true",
+                            help="clear the in-process caches before every action")
+    arg_parser.add_argument("--parse-number", type=int, default=50)
+    arg_parser.add_argument("--save", nargs="?", const="", default=None,
+                            help="write the results as JSON, to benchmarks/results/ by default")
+    arg_parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                            help="compare two saved results instead of running")
+    arg_parser.add_argument("--check", action="store_true",
+                            help="check the caches after shelf removals instead of running")
+    args = arg_parser.parse_args()
+
+    if args.compare:
+        return report.print_comparison(*map(report.load, args.compare))
+    if args.check:
+        raise SystemExit(0 if check(args) else 1)
+
+    results = run(args)
+    print_results(results)
+
+    if args.save is not None:
+        print(f"\nsaved to {report.save('handlers', results, args.save or None)}")
+
+
+if __name__ == "__main__":
+    main()
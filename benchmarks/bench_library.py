@@ -0,0 +1,97 @@
+"""Build time, memory and query latency of the in-library search index
+over synthetic libraries.
+
+    python -m benchmarks.bench_library --books 10000 50000
+"""
+import argparse
+import random
+import statistics
+import time
+import tracemalloc
+
+from library import LibraryIndex
+from models import Book, authors
+
+WORDS = (
+    "the of and a in to war peace night day house garden city river "
+    "dark light lost found last first secret history love death king "
+    "queen stone fire water shadow glass silent black white red world "
+    "star sea mountain road journey winter summer iron golden children "
+    "memory dream girl boy man woman island empire machine song"
+).split()
+SHELVES = ("read", "to-read", "currently-reading", "favorites", "owned")
+
+
+def vocabulary(rng, count=5000):
+    # the common words above plus rarer made-up ones, titles use both
+    syllables = ("ka", "lo", "mer", "ti", "sa", "ven", "dor", "ri", "an", "el", "mo", "ush")
+    rare = {"".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(count)}
+
+    return sorted(rare)
+
+
+def library(count, seed=0):
+    rng = random.Random(seed)
+    rare = vocabulary(rng)
+    names = [f"{rng.choice(rare).title()}" for _ in range(count // 5 + 1)]
+
+    for book_id in range(1, count + 1):
+        words = [rng.choice(WORDS if rng.random() < 0.5 else rare) for _ in range(rng.randint(2, 6))]
+        written_by = [f"{rng.choice(names)} {rng.choice(names)}" for _ in range(rng.randint(1, 2))]
+        book = Book(
+            id=str(book_id),
+            title=" ".join(words).title(),
+            authors=authors(written_by),
+            link=f"https://www.goodreads.com/book/show/{book_id}",
+        )
+        yield book, rng.choice(SHELVES)
+
+
+def queries(count, seed=1):
+    rng = random.Random(seed)
+    rare = vocabulary(random.Random(0))
+    for _ in range(count):
+        words = [rng.choice(WORDS if rng.random() < 0.5 else rare) for _ in range(rng.randint(1, 3))]
+        # people type the last word partially
+        words[-1] = words[-1][:rng.randint(min(2, len(words[-1])), len(words[-1]))]
+        yield " ".join(words)
+
+
+def percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--books", type=int, nargs="+", default=[1000, 10000, 50000])
+    arg_parser.add_argument("--queries", type=int, default=2000)
+    args = arg_parser.parse_args()
+
+    print(f"{'books':>8}{'build ms':>10}{'MiB':>8}{'p50 us':>9}{'p99 us':>9}{'avg hits':>10}")
+    for count in args.books:
+        books = list(library(count))
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        index = LibraryIndex(complete=True)
+        for book, shelf in books:
+            index.add(book, shelf)
+        build = time.perf_counter() - started
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        timings = []
+        hits = []
+        for query in queries(args.queries):
+            started = time.perf_counter()
+            hits.append(len(index.search(query, limit=5)))
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+
+        print(f"{count:>8}{build * 1e3:>10.1f}{memory / 2 ** 20:>8.1f}"
+              f"{percentile(timings, 50) * 1e6:>9.1f}{percentile(timings, 99) * 1e6:>9.1f}"
+              f"{statistics.mean(hits):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Logging cost per update on the handler threads: eager f-strings written
+synchronously (the old basicConfig setup) vs. lazy records handed to the
+queue pipeline in logs.py.
+
+    python -m benchmarks.bench_logging --updates 20000 --threads 8
+"""
+import argparse
+import logging
+import tempfile
+import threading
+import time
+
+from logs import LOG_FORMAT, LogPipeline, SampledLogger
+
+logger = logging.getLogger("bot")
+inline_logger = SampledLogger(logger, 0.05)
+
+RESULT = "\n\n".join(
+    f"*Book title number {n}* [→](https://www.goodreads.com/book/show/{n})\n"
+    f"Some Author, Another Author\n/book\\_{n} "
+    for n in range(5)
+)
+
+
+def books_eager(user_id, data):
+    logger.info(f"message: {data}")
+    logger.info((f"user_id: {user_id}, "
+                 f"shelf:to-read, "
+                 f" page:2"))
+    logger.info(str(RESULT))
+
+
+def inlinequery_eager(user_id, query):
+    logger.info(f"query: {query}, page: 1")
+
+
+def books(user_id, data):
+    logger.info("message: %s", data)
+    logger.info("user_id: %s, shelf: %s, page: %s", user_id, "to-read", 2)
+    logger.debug("rendered %s books", 5)
+
+
+def inlinequery(user_id, query):
+    inline_logger.info("query: %s, page: %s", query, 1)
+
+
+def update(n, books, inlinequery):
+    # one shelf page and a few keystrokes of an inline query
+    books(n, f"books_to-read_{n % 7}")
+    for end in range(1, 6):
+        inlinequery(n, "harry potter"[:end])
+
+
+def run(threads, updates, books, inlinequery):
+    per_thread = updates // threads
+
+    def work(offset):
+        for n in range(offset, offset + per_thread):
+            update(n, books, inlinequery)
+
+    workers = [threading.Thread(target=work, args=(i * per_thread,)) for i in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return time.perf_counter() - started, per_thread * threads
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--updates", type=int, default=20000)
+    arg_parser.add_argument("--threads", type=int, default=8)
+    arg_parser.add_argument("--queue-size", type=int, default=None,
+                            help="default: room for every record, so none are dropped")
+    args = arg_parser.parse_args()
+    # a shelf page logs 2 records, the keystrokes about 0.25 sampled in;
+    # a full queue makes put_nowait() cheaper and the figure meaningless
+    queue_size = args.queue_size or args.updates * 3
+
+    root = logging.getLogger()
+
+    with tempfile.TemporaryFile("w") as output:
+        handler = logging.StreamHandler(output)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT.replace("[%(update_id)s] ", "")))
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+        elapsed, count = run(args.threads, args.updates, books_eager, inlinequery_eager)
+        root.removeHandler(handler)
+        print(f"synchronous, eager: {elapsed / count * 1e6:8.1f} us/update on the handler threads")
+
+    with tempfile.TemporaryFile("w") as output:
+        pipeline = LogPipeline(level="INFO", levels={}, queue_size=queue_size, stream=output).start()
+        elapsed, count = run(args.threads, args.updates, books, inlinequery)
+        started = time.perf_counter()
+        stats = pipeline.stats()
+        pipeline.stop()
+        drain = time.perf_counter() - started
+        print(f"queued, lazy:       {elapsed / count * 1e6:8.1f} us/update on the handler threads "
+              f"with {stats['dropped']} records dropped (queue {queue_size}), "
+              f"{drain:.2f}s to drain, {stats['sampled_out']} sampled out")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Bytes per cached entry of the search, shelves, shelf page and book
+caches: the dicts the parsers used to build vs. the models in models.py.
+Each entry is parsed from its own copy of the recorded fixture, like
+separate responses would be.
+
+    python -m benchmarks.bench_memory --entries 2000
+"""
+import argparse
+import io
+import tracemalloc
+
+import models
+from benchmarks.bench_parse import load
+from parsers import LxmlParser
+
+
+class DictParser(LxmlParser):
+    # the parser methods as they were before models.py
+
+    def authors(self, entry):
+        return [self.fields(author, ('name',))['name'] for author in entry.iter('author')]
+
+    def search_books(self, source):
+        books = []
+        for entry in self.iterparse(source, 'best_book'):
+            book = self.fields(entry, ('id', 'title', 'image_url'))
+            book['authors'] = self.authors(entry)
+
+            books.append(book)
+
+        return books
+
+    def shelves(self, source):
+        shelves = []
+        for entry in self.iterparse(source, 'user_shelf'):
+            shelf = self.fields(entry, ('name', 'book_count'))
+            shelf['show_name'] = " ".join(shelf['name'].split("-")).title()
+
+            shelves.append(shelf)
+
+        return shelves
+
+    def books(self, source):
+        books = []
+        for entry in self.iterparse(source, 'book'):
+            book = self.fields(entry, ('id', 'title', 'publication_year', 'link'))
+            book['authors'] = self.authors(entry)
+
+            books.append(book)
+
+        return books
+
+    def book(self, content):
+        book_xml = self.fromstring(content).find('book')
+
+        fields = self.fields(book_xml, ('title', 'description', 'link',
+                                        'image_url', 'small_image_url'))
+        book = {
+            'title': fields['title'],
+            'authors': self.authors(book_xml.find('authors')),
+            'description': fields['description'],
+            'link': fields['link'],
+            'image': fields['image_url'] or fields['small_image_url'],
+        }
+        shelf_xml = book_xml.find('./my_review/shelves/shelf')
+        shelf = shelf_xml.attrib['name'] if shelf_xml is not None else None
+
+        return book, shelf
+
+
+# (cache, fixture, parser method)
+CASES = (
+    ("search", "search.xml", "search_books"),
+    ("shelves", "shelves.xml", "shelves"),
+    ("shelf page", "review_list.xml", "books"),
+    ("book", "book_show.xml", "book"),
+)
+
+
+def measure(parser, method, content, entries):
+    # traced bytes still held by `entries` parsed results, shared authors
+    # and interned names included
+    models.author.cache_clear()
+    sources = [bytes(content) for _ in range(entries)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    if method == "book":
+        cached = [parser.book(source) for source in sources]
+    else:
+        cached = [getattr(parser, method)(io.BytesIO(source)) for source in sources]
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    del cached
+    return held / entries
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--entries", type=int, default=2000)
+    args = arg_parser.parse_args()
+
+    print(f"{'cache':<12}{'dicts B':>10}{'models B':>10}{'saved':>8}")
+    for name, fixture, method in CASES:
+        content = load(fixture)
+        before = measure(DictParser(), method, content, args.entries)
+        after = measure(LxmlParser(), method, content, args.entries)
+        print(f"{name:<12}{before:>10.0f}{after:>10.0f}{1 - after / before:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Parse time of the stdlib and lxml parsers over the recorded Goodreads
+fixtures.
+
+    python -m benchmarks.bench_parse --number 200 --scale 50
+"""
+import argparse
+import io
+import os
+import re
+import timeit
+
+from parsers import ElementTreeParser, LxmlParser
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# (fixture, parser method, entry tag used by --scale)
+CASES = (
+    ("search.xml", "search_books", "work"),
+    ("shelves.xml", "shelves", "user_shelf"),
+    ("review_list.xml", "books", "review"),
+    ("book_show.xml", "book", None),
+    ("review_show.xml", "review_shelf", None),
+)
+
+
+def load(name, tag=None, scale=1):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        content = f.read()
+
+    if tag and scale > 1:
+        # repeat the list entries to get a large response
+        entries = re.findall(rb"<%s>.*?</%s>" % (tag.encode(), tag.encode()), content, re.S)
+        extra = b"\n".join(entries) * (scale - 1)
+        content = content.replace(entries[-1], entries[-1] + extra, 1)
+
+    return content
+
+
+def parse(parser, method, content):
+    if method in ("book", "review_shelf"):
+        return getattr(parser, method)(content)
+    return getattr(parser, method)(io.BytesIO(content))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--number", type=int, default=200)
+    arg_parser.add_argument("--scale", type=int, default=1,
+                            help="repeat list entries this many times")
+    args = arg_parser.parse_args()
+
+    parsers = (ElementTreeParser(), LxmlParser())
+
+    print(f"{'fixture':<18}{'parser':<8}{'bytes':>10}{'us/parse':>12}")
+    for name, method, tag in CASES:
+        content = load(name, tag, args.scale)
+        for parser in parsers:
+            seconds = timeit.timeit(lambda: parse(parser, method, content),
+                                    number=args.number)
+            print(f"{name:<18}{parser.name:<8}{len(content):>10}"
+                  f"{seconds / args.number * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
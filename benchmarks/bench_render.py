@@ -0,0 +1,162 @@
+"""Render time of book cards and shelf keyboards: built on every view (the
+old bot.py renderers) vs. memoized in render.py. Views pick books from a
+synthetic library with a skewed popularity, so the same books come up
+again and again like they do in real traffic.
+
+    python -m benchmarks.bench_render --views 20000 --books 10000
+"""
+import argparse
+import random
+import re
+import time
+from uuid import uuid4
+
+from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,
+                      InlineQueryResultArticle, InputTextMessageContent,
+                      ParseMode)
+
+import render
+from benchmarks.bench_library import library
+from models import Shelf
+
+SHELVES = [Shelf(name, 10, " ".join(name.split("-")).title())
+           for name in ("read", "to-read", "currently-reading", "favorites", "owned", "sci-fi")]
+
+
+def strip_tags(text):
+    clean = re.compile("<.*?>")
+    return re.sub(clean, "", text)
+
+
+def search_page(books):
+    result = []
+    for book in books:
+        result.append(
+            f"*{strip_tags(book.title)}*{' 📚' if book.shelves else ''} \n"
+            f"{book.author_names}\n"
+            f"/book\_{book.id} "  # noqa
+        )
+    return "\n\n".join(result)
+
+
+def shelf_page(books):
+    result = []
+    for book in books:
+        result.append(
+            f"*{strip_tags(book.title)}* "
+            f"[→]({book.link})\n"
+            f"{book.author_names}\n"
+            f"/book\_{book.id} "  # noqa
+        )
+    return "\n\n".join(result)
+
+
+def inline_answer(books):
+    result = []
+    for book in books:
+        book_md = (
+            f"*{strip_tags(book.title)}* \n"
+            f"{book.author_names}\n"
+            f"[На сайте 🌎](https://www.goodreads.com/book/show/{book.id})"
+        )
+        add_book_button = InlineKeyboardButton("Добавить книгу 📚", callback_data=f"inlinebook {book.id}")
+        result.append(InlineQueryResultArticle(
+            id=uuid4(),
+            title=strip_tags(book.title) + (" 📚" if book.shelves else ""),
+            thumb_url=book.image_url,
+            description=book.author_names,
+            input_message_content=InputTextMessageContent(book_md, ParseMode.MARKDOWN),
+            reply_markup=InlineKeyboardMarkup([[add_book_button]]),
+        ))
+    return result
+
+
+def book_view(book, shelf, shelves):
+    book_md = f"*{book.title}* \n{book.author_names}\n\n"
+    if book.description:
+        book_md = book_md + f"{book.description[:200]}... "
+    book_md = strip_tags(book_md + f"[На сайте 🌎]({book.link})\n")
+
+    shelves = {shelf.show_name: shelf.name for shelf in shelves}
+    shelves['Remove 🗑'] = "remove" if shelf else None
+    buttons = []
+    for text, value in shelves.items():
+        if text != 'Remove 🗑':
+            button_text = text if shelf != value else f"{text} 📚"
+            callback_data = f'add_to_shelf {value} {book.id}'
+        elif bool(shelf):
+            button_text = 'Remove 🗑'
+            callback_data = f'rm_from_shelf {shelf} {book.id}'
+        else:
+            continue
+        buttons.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
+
+    return book_md, InlineKeyboardMarkup(buttons)
+
+
+def search_page_memoized(books):
+    return "\n\n".join(map(render.search_card, books))
+
+
+def shelf_page_memoized(books):
+    return "\n\n".join(map(render.shelf_card, books))
+
+
+def inline_answer_memoized(books):
+    return [InlineQueryResultArticle(id=uuid4(), **render.inline_card(book)) for book in books]
+
+
+def book_view_memoized(book, shelf, shelves):
+    return render.book_card(book), render.book_keyboard(render.shelf_set(shelves), shelf, book.id)
+
+
+def views(books, count, seed=0):
+    # (kind, books, shelf) with zipf-like popularity over `books`
+    rng = random.Random(seed)
+    weights = [1 / rank for rank in range(1, len(books) + 1)]
+    for _ in range(count):
+        kind = rng.choice(("search", "shelf", "inline", "book"))
+        if kind == "book":
+            book, shelf = rng.choices(books, weights)[0]
+            yield kind, [book], shelf
+        else:
+            yield kind, [book for book, _ in rng.choices(books, weights, k=20)], None
+
+
+def run(workload, renderers):
+    started = time.perf_counter()
+    for kind, books, shelf in workload:
+        if kind == "book":
+            renderers[kind](books[0], shelf, SHELVES)
+        else:
+            renderers[kind](books)
+
+    return time.perf_counter() - started
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--views", type=int, default=20000)
+    arg_parser.add_argument("--books", type=int, default=10000)
+    args = arg_parser.parse_args()
+
+    books = []
+    for book, shelf in library(args.books):
+        books.append((book._replace(description="A book <br />" * 40, shelves=(shelf,)), shelf))
+    workload = list(views(books, args.views))
+
+    before = run(workload, {"search": search_page, "shelf": shelf_page,
+                            "inline": inline_answer, "book": book_view})
+    render.clear()
+    after = run(workload, {"search": search_page_memoized, "shelf": shelf_page_memoized,
+                           "inline": inline_answer_memoized, "book": book_view_memoized})
+
+    print(f"built every view: {before / args.views * 1e6:8.1f} us/view")
+    print(f"memoized:         {after / args.views * 1e6:8.1f} us/view")
+    for name, counters in render.stats().items():
+        total = counters["hits"] + counters["misses"]
+        print(f"  {name:<14}{counters['hits'] / total if total else 0:>6.0%} hits, {counters['size']} entries")
+
+
+if __name__ == "__main__":
+    main()
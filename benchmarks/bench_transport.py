@@ -0,0 +1,85 @@
+"""Count TCP connections (handshakes) opened against a local keep-alive
+server for a session per call, a session per user and the shared transport.
+
+    python -m benchmarks.bench_transport --users 50 --requests 10
+"""
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from rauth.session import OAuth1Session
+
+from transport import GoodreadsSession
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b"<GoodreadsResponse/>"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+
+def run(session_cls, per_call, url, users, requests, workers):
+    def user_action(user):
+        session = session_cls("key", "secret", f"token{user}", "token_secret")
+        for _ in range(requests):
+            if per_call:
+                session = session_cls("key", "secret", f"token{user}", "token_secret")
+            session.get(url, params={"key": "key"}).content
+
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(user_action, range(users)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    modes = (
+        ("session per call", OAuth1Session, True),
+        ("session per user", OAuth1Session, False),
+        ("shared transport", GoodreadsSession, False),
+    )
+    for name, session_cls, per_call in modes:
+        server = CountingServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        url = f"http://127.0.0.1:{server.server_address[1]}/search/index.xml"
+        run(session_cls, per_call, url, args.users, args.requests, args.workers)
+
+        server.shutdown()
+        server.server_close()
+
+        total = args.users * args.requests
+        print(f"{name:>18}: {total} requests, {server.connections} handshakes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""Synthetic user traffic fed through a Dispatcher with the bot.py handlers,
+against the fake goodreads.com and the Postgres from DATABASE_URL. Users
+arrive at --rate sessions per second for --duration seconds, each session
+is one of: typing an inline query, a search and its next page, paging a
+shelf, opening books, adding and removing a book.
+
+    python -m benchmarks.load --users 200 --rate 20 --duration 30 --latency 0.2
+"""
+import argparse
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from queue import Queue
+
+from benchmarks import report
+from benchmarks.bench_handlers import (FIRST_USER_ID, SEARCHES, add_users,
+                                       remove_users)
+from benchmarks.fakes import FakeBot, FakeGoodreads, Updates
+
+# session kind -> relative weight
+MIX = {
+    "typing": 3,
+    "search": 2,
+    "shelf": 3,
+    "book": 3,
+    "add_remove": 1,
+}
+
+
+def typing(updates, user_id, rng):
+    query = rng.choice(SEARCHES)
+    for end in range(1, len(query) + 1):
+        yield rng.uniform(0.08, 0.25), updates.inline(user_id, query[:end])
+
+
+def search(updates, user_id, rng):
+    query = rng.choice(SEARCHES)
+    yield 0, updates.message(user_id, query)
+    yield rng.uniform(1, 4), updates.callback(user_id, f"search_books 2 {query}")
+
+
+def shelf(updates, user_id, rng):
+    yield 0, updates.command(user_id, "/shelves")
+    shelf = rng.choice(("to-read", "read", "currently-reading"))
+    for page in range(1, rng.randint(2, 5)):
+        yield rng.uniform(1, 3), updates.callback(user_id, f"books_{shelf}_{page}")
+
+
+def book(updates, user_id, rng):
+    for _ in range(rng.randint(1, 3)):
+        yield rng.uniform(0.5, 3), updates.message(user_id, f"/book_{rng.randint(1, 2000)}")
+
+
+def add_remove(updates, user_id, rng):
+    book_id = rng.randint(1, 2000)
+    yield 0, updates.message(user_id, f"/book_{book_id}")
+    yield rng.uniform(1, 3), updates.callback(user_id, f"add_to_shelf read {book_id}")
+    yield rng.uniform(1, 3), updates.callback(user_id, f"rm_from_shelf read {book_id}")
+
+
+SESSIONS = {
+    "typing": typing,
+    "search": search,
+    "shelf": shelf,
+    "book": book,
+    "add_remove": add_remove,
+}
+
+
+def schedule(updates, users, rate, duration, seed=0):
+    # (seconds from start, update) for every session starting in `duration`
+    rng = random.Random(seed)
+    kinds, weights = zip(*MIX.items())
+
+    events = []
+    started = 0.0
+    while True:
+        started += rng.expovariate(rate)
+        if started >= duration:
+            break
+
+        user_id = FIRST_USER_ID + rng.randrange(users)
+        at = started
+        for delay, update in SESSIONS[rng.choices(kinds, weights)[0]](updates, user_id, rng):
+            at += delay
+            events.append((at, update.update_id, update))
+
+    heapq.heapify(events)
+
+    return [heapq.heappop(events) for _ in range(len(events))]
+
+
+class Metrics():
+    # end-to-end latency per update and how busy the worker pool is
+
+    def __init__(self, workers):
+        self.workers = workers
+
+        self._lock = threading.Lock()
+        self._enqueued = {}
+        self.latencies = defaultdict(list)
+        self.completed = 0
+        self.errors = 0
+        self.active = 0
+        self.samples = []
+        self.done = threading.Event()
+        self.expected = 0
+
+    def enqueued(self, update):
+        with self._lock:
+            self._enqueued[update.update_id] = time.perf_counter()
+
+    def wrap(self, callback):
+        def wrapper(update, context):
+            with self._lock:
+                self.active += 1
+            try:
+                return callback(update, context)
+            finally:
+                finished = time.perf_counter()
+                with self._lock:
+                    self.active -= 1
+                    self.latencies[callback.__name__].append(
+                        finished - self._enqueued.pop(update.update_id))
+                    self.completed += 1
+                    if self.completed >= self.expected:
+                        self.done.set()
+
+        return wrapper
+
+    def error(self, update, context):
+        with self._lock:
+            self.errors += 1
+
+    def sample(self, dispatcher, stop, interval=0.05):
+        while not stop.wait(interval):
+            with self._lock:
+                active = self.active
+            # run_async jobs waiting for a free worker, private in PTB 13
+            jobs = dispatcher._Dispatcher__async_queue.qsize()
+            self.samples.append((active, dispatcher.update_queue.qsize(), jobs))
+
+    def saturation(self):
+        if not self.samples:
+            return {}
+
+        active, updates, jobs = zip(*self.samples)
+        return {
+            "workers": self.workers,
+            "max_active": max(active),
+            "mean_active": sum(active) / len(active),
+            "saturated_share": sum(n >= self.workers for n in active) / len(active),
+            "max_update_queue": max(updates),
+            "max_worker_queue": max(jobs),
+            "mean_worker_queue": sum(jobs) / len(jobs),
+        }
+
+
+def run(args):
+    fake = FakeGoodreads(latency=args.latency).start()
+    os.environ["GOODREADS_URL"] = fake.url
+
+    # imported late, config is read from the environment at import
+    from telegram.ext import Dispatcher
+
+    import bot
+    from config import DISPATCHER_WORKERS
+    from postgres import pool
+    from ratelimit import scheduler
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    fake_bot = FakeBot()
+    updates = Updates(fake_bot)
+    events = schedule(updates, args.users, args.rate, args.duration, args.seed)
+
+    metrics = Metrics(DISPATCHER_WORKERS)
+    metrics.expected = len(events)
+
+    dispatcher = Dispatcher(fake_bot, Queue(), workers=DISPATCHER_WORKERS)
+    bot.add_handlers(dispatcher)
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            handler.callback = metrics.wrap(handler.callback)
+    dispatcher.add_error_handler(metrics.error)
+    bot.add_lanes(dispatcher)
+
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + args.users)
+    add_users(pool, user_ids)
+    pool_before = pool.stats()
+
+    stop = threading.Event()
+    threading.Thread(target=dispatcher.start, daemon=True).start()
+    threading.Thread(target=metrics.sample, args=(dispatcher, stop), daemon=True).start()
+
+    print(f"{len(events)} updates from {args.users} users over {args.duration}s")
+    started = time.perf_counter()
+    try:
+        for at, _, update in events:
+            delay = started + at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            metrics.enqueued(update)
+            dispatcher.update_queue.put(update)
+
+        deadline = time.perf_counter() + args.drain
+        while not metrics.done.wait(0.05) and time.perf_counter() < deadline:
+            # double taps dropped by the user lanes never complete
+            if metrics.completed + bot.user_lanes.stats()["duplicates"] >= metrics.expected:
+                break
+        elapsed = time.perf_counter() - started
+    finally:
+        stop.set()
+        dispatcher.stop()
+        for user_id in user_ids:
+            bot.goodreads_api.forget_user(user_id)
+        remove_users(pool, user_ids)
+        fake.stop()
+
+    pool_after = pool.stats()
+    all_latencies = [value for values in metrics.latencies.values() for value in values]
+
+    return {
+        "config": {
+            "users": args.users,
+            "rate": args.rate,
+            "duration": args.duration,
+            "latency": args.latency,
+            "workers": DISPATCHER_WORKERS,
+        },
+        "updates": len(events),
+        "completed": metrics.completed,
+        "errors": metrics.errors,
+        "duplicates": bot.user_lanes.stats()["duplicates"],
+        "elapsed": elapsed,
+        "throughput": metrics.completed / elapsed,
+        "latency": report.summary(all_latencies),
+        "handlers": {name: report.summary(values) for name, values in metrics.latencies.items()},
+        "saturation": metrics.saturation(),
+        "db_pool": {
+            "checkouts": pool_after["checkouts"] - pool_before["checkouts"],
+            "waits": pool_after["waits"] - pool_before["waits"],
+            "wait_time": pool_after["wait_time"] - pool_before["wait_time"],
+            "max_wait_time": pool_after["max_wait_time"],
+            "timeouts": pool_after["timeouts"] - pool_before["timeouts"],
+            "max_in_use": pool_after["max_in_use"],
+            "size": pool_after["size"],
+        },
+        "upstream": {
+            "calls": dict(fake.calls()),
+            "scheduler": scheduler.stats(),
+        },
+        "bot_calls": dict(Counter(fake_bot.sent)),
+    }
+
+
+def print_results(results):
+    print(f"completed {results['completed']}/{results['updates']} updates in "
+          f"{results['elapsed']:.1f}s, {results['throughput']:.1f} updates/s, "
+          f"{results['errors']} errors, {results['duplicates']} dropped as double taps")
+
+    print(f"\n{'handler':<14}{'count':>7}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name, latency in [("all", results["latency"]), *results["handlers"].items()]:
+        print(f"{name:<14}{latency['count']:>7}{latency['p50']:>9.1f}{latency['p90']:>9.1f}"
+              f"{latency['p99']:>9.1f}{latency['max']:>9.1f}")
+
+    saturation = results["saturation"]
+    print(f"\nworkers: {saturation['max_active']}/{saturation['workers']} max busy, "
+          f"{saturation['mean_active']:.1f} mean, saturated {saturation['saturated_share']:.0%} "
+          f"of the time, worker queue max {saturation['max_worker_queue']}")
+
+    db_pool = results["db_pool"]
+    print(f"db pool: {db_pool['checkouts']} checkouts, {db_pool['waits']} waited "
+          f"({db_pool['wait_time']:.2f}s total, {db_pool['max_wait_time'] * 1e3:.1f}ms max), "
+          f"{db_pool['timeouts']} timeouts, {db_pool['max_in_use']}/{db_pool['size']} max in use")
+
+    calls = results["upstream"]["calls"]
+    print(f"goodreads: {sum(calls.values())} calls {dict(calls)}")
+    for name, counters in results["upstream"]["scheduler"].items():
+        if isinstance(counters, dict) and counters["requests"]:
+            print(f"rate limiter, {name}: {counters['requests']} requests, "
+                  f"{counters['wait_time'] / counters['requests'] * 1e3:.0f}ms mean wait, "
+                  f"{counters['max_wait_time'] * 1e3:.0f}ms max")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--users", type=int, default=200)
+    arg_parser.add_argument("--rate", type=float, default=10,
+                            help="new user sessions per second")
+    arg_parser.add_argument("--duration", type=float, default=30)
+    arg_parser.add_argument("--latency", type=float, default=0.2,
+                            help="seconds the fake goodreads.com takes per response")
+    arg_parser.add_argument("--drain", type=float, default=60,
+                            help="seconds to wait for queued updates after the last one")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--save", nargs="?", const="", default=None)
+    args = arg_parser.parse_args()
+
+    results = run(args)
+    print_results(results)
+
+    if args.save is not None:
+        print(f"\nsaved to {report.save('load', results, args.save or None)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Latency summaries and saved benchmark results that later runs can be
+compared with.
+"""
+import json
+import os
+import statistics
+import time
+
+RESULTS = os.path.join(os.path.dirname(__file__), "results")
+
+
+def summary(seconds):
+    # milliseconds
+    values = sorted(seconds)
+    if not values:
+        return {"count": 0}
+
+    def pct(p):
+        return values[min(len(values) - 1, int(len(values) * p / 100))] * 1e3
+
+    return {
+        "count": len(values),
+        "mean": statistics.mean(values) * 1e3,
+        "p50": pct(50),
+        "p90": pct(90),
+        "p99": pct(99),
+        "max": values[-1] * 1e3,
+    }
+
+
+def save(name, results, path=None):
+    if path is None:
+        os.makedirs(RESULTS, exist_ok=True)
+        path = os.path.join(RESULTS, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    return path
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def flatten(results, prefix=""):
+    # {"a": {"b": 1}} -> {"a.b": 1}, numbers only
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+
+    return flat
+
+
+def compare(before, after):
+    before, after = flatten(before), flatten(after)
+
+    rows = []
+    for key in sorted(before.keys() | after.keys()):
+        old, new = before.get(key), after.get(key)
+        if old == new:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else ""
+        rows.append((key, old, new, change))
+
+    return rows
+
+
+def print_comparison(before, after):
+    print(f"{'metric':<52}{'before':>12}{'after':>12}{'change':>10}")
+    for key, old, new, change in compare(before, after):
+        old = "-" if old is None else f"{old:.2f}"
+        new = "-" if new is None else f"{new:.2f}"
+        print(f"{key:<52}{old:>12}{new:>12}{change:>10}")
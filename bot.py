@@ -2,25 +2,50 @@ import logging
 import os
 from uuid import uuid4
 
-from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,
+from telegram import (ChatAction, InlineKeyboardButton, InlineKeyboardMarkup,
                       InlineQueryResultArticle, InputTextMessageContent,
                       ParseMode)
 from telegram.ext import (CallbackQueryHandler, CommandHandler,
                           InlineQueryHandler, MessageHandler, Updater)
 from telegram.ext.filters import Filters
 
-from api import ApiError, AuthError, goodreads_api
-from config import APP_URL, PORT, TELEGRAM_BOT_TOKEN
-from postgres import conn
-from service import goodreads_service
-from utils import strip_tags
-
-logging.basicConfig(level=logging.DEBUG,
-                    format="%(filename)s[LINE:%(lineno)d]# - "
-                           "%(asctime)s - "
-                           "%(funcName)s: "
-                           "%(message)s")
+import export
+import logs
+import metrics
+import render
+import tiered
+from api import (SEARCH_WINDOW, UPSTREAM_ERRORS, ApiError, AuthError,
+                 book_pages_cache, books_cache, goodreads_api, libraries,
+                 search_cache, search_flight, served_stale, shelf_state_cache,
+                 shelves_cache)
+from breaker import breaker
+from config import (APP_URL, BULK_MAX_BOOKS, DISPATCHER_WORKERS,
+                    INLINE_DEBOUNCE, LOG_SAMPLE_INLINE, PORT,
+                    TELEGRAM_BOT_TOKEN, USER_LANES)
+from cursors import cursors
+from flight import LatestOnly
+from lanes import UserLanes
+from library import EXCLUSIVE_SHELVES
+from postgres import pool
+from prefetch import prefetcher, revalidator
+from ratelimit import SEARCH, priority, scheduler
+from service import goodreads_service, sessions_cache
+from sync import shelf_sync
+from transport import adapter
+
 logger = logging.getLogger(__name__)
+# one record per keystroke is too much, keep a sample
+inline_logger = logs.SampledLogger(logger, LOG_SAMPLE_INLINE)
+
+# chat search results per message
+SEARCH_PER_PAGE = 5
+
+STALE_NOTE = "\n\n_⚠️ Goodreads не отвечает, данные могут быть устаревшими_"
+
+# newer inline queries from the same user supersede older pending ones
+inline_queries = LatestOnly(debounce=INLINE_DEBOUNCE)
+# one user's updates run in order, double taps are dropped
+user_lanes = UserLanes()
 
 
 def start_handler(update, context):
@@ -35,45 +60,63 @@ def start_handler(update, context):
 
 def search_books(update, context):
     page = 1
+    cursor_id = None
     if not update.message:
-        logger.info(f"message: {update.callback_query.data}")
-        page = int(update.callback_query.data.split(' ')[1])
-        search_query = " ".join(update.callback_query.data.split(' ')[2:])
-        user_id = update.callback_query.from_user.id
+        query = update.callback_query
+        logger.info("message: %s", query.data)
+        user_id = query.from_user.id
+        if query.data.startswith('search_page '):
+            _, cursor_id, page = query.data.split(' ')
+            page = int(page)
+            cursor = cursors.get(cursor_id, user_id, 'search')
+            if cursor is None:
+                return query.answer("Результаты устарели, повторите поиск")
+            search_query = cursor["params"]["query"]
+        else:
+            # buttons sent before the cursors, "search_books {page} {query}"
+            page = int(query.data.split(' ')[1])
+            search_query = " ".join(query.data.split(' ')[2:])
     else:
-        logger.info(f"message: {update.message.text}")
+        logger.info("message: %s", update.message.text)
         user_id = update.message.from_user.id
         search_query = update.message.text
 
-    logger.info((f"user_id: {user_id}, "
-                 f"search_query:{search_query}, "
-                 f" page:{page}"))
+    if cursor_id is None:
+        cursor_id = cursors.create(user_id, 'search', query=search_query)
+        cursor = cursors.get(cursor_id, user_id, 'search')
 
-    try:
-        books = goodreads_api.get_search_books(user_id, search_query,
-                                               page=page)
-    except AuthError as ex:
-        logger.error(f"AuthError: user_id {user_id}")
-        return context.bot.send_message(user_id, text=str(ex))
+    logger.info("user_id: %s, search_query: %s, page: %s", user_id, search_query, page)
 
-    result = []
-    for index, book in enumerate(books):
-        book_md = (
-            f"*{strip_tags(book['title'])}* \n"
-            f"{', '.join(book['authors'])}\n"
-            f"/book\_{book['id']} "  # noqa
-        )
-        result.append(book_md)
+    books = cursors.page(cursor, page)
+    if books is None:
+        try:
+            books = goodreads_api.get_search_books(user_id, search_query,
+                                                   page=page, per_page=SEARCH_PER_PAGE)
+        except AuthError as ex:
+            logger.error("AuthError: user_id %s", user_id)
+            return context.bot.send_message(user_id, text=str(ex))
+
+        stale = served_stale()
+
+        if page == 1:
+            books = _with_library(user_id, search_query, books)
+
+        if not stale:
+            cursors.save_page(cursor_id, cursor, page, books)
+    else:
+        stale = False
+
+    result = [render.search_card(book) for book in books]
 
     buttons = []
     if page > 1:
-        callback_data = f'search_books {page-1} {search_query}'
+        callback_data = f'search_page {cursor_id} {page-1}'
         buttons.append(
             InlineKeyboardButton("⬅️", callback_data=callback_data)
         )
 
     if books:
-        callback_data = f'search_books {page+1} {search_query}'
+        callback_data = f'search_page {cursor_id} {page+1}'
         buttons.append(
             InlineKeyboardButton("➡️", callback_data=callback_data)
         )
@@ -85,6 +128,8 @@ def search_books(update, context):
         result = "*Ничего не найдено!*"
     else:
         result = "*Это всё!*"
+    if stale:
+        result += STALE_NOTE
 
     params = {
         "text": result,
@@ -97,32 +142,48 @@ def search_books(update, context):
     else:
         update.message.reply_markdown(**params)
 
+    # a next page inside the SEARCH_WINDOW books just fetched is cached already
+    if books and cursors.page(cursor, page + 1) is None and page * SEARCH_PER_PAGE % SEARCH_WINDOW == 0:
+        prefetcher.schedule(user_id, goodreads_api.get_search_books,
+                            user_id, search_query, page=page + 1, per_page=SEARCH_PER_PAGE)
+
+
+def _with_library(user_id, search_query, books):
+    # matches from the user's own shelves go first
+    owned = goodreads_api.search_library(user_id, search_query)
+    owned_ids = {book.id for book in owned}
+
+    return owned + [book for book in books if book.id not in owned_ids]
+
 
 def shelves(update, context):
     if not update.message:
-        logger.info(f"message: {update.callback_query.data}")
+        logger.info("message: %s", update.callback_query.data)
         user_id = update.callback_query.from_user.id
     else:
-        logger.info(f"message: {update.message.text}")
+        logger.info("message: %s", update.message.text)
         user_id = update.message.from_user.id
 
-    logger.info(f"user_id: {user_id}")
+    logger.info("user_id: %s", user_id)
+    prefetcher.cancel(user_id)
+    shelf_sync.touch(user_id)
 
     try:
         shelves = goodreads_api.get_shelves(user_id)
     except AuthError as ex:
-        logger.error(f"AuthError: user_id {user_id}")
+        logger.error("AuthError: user_id %s", user_id)
         return context.bot.send_message(user_id, text=str(ex))
+    stale = served_stale()
 
     buttons = []
     for s in shelves:
         buttons.append(
-            [InlineKeyboardButton(f"{s['show_name']}({s['book_count']})",
-                                  callback_data=f"books_{s['name']}_1")]
+            [InlineKeyboardButton(f"{s.show_name}({s.book_count})",
+                                  callback_data=f"books_{s.name}_1")]
         )
 
     params = {
-        "text": "Выберите полку 📚",
+        "text": "Выберите полку 📚" + (STALE_NOTE if stale else ""),
         "parse_mode": ParseMode.MARKDOWN,
         "disable_web_page_preview": True,
         "reply_markup": InlineKeyboardMarkup(buttons),
@@ -137,50 +198,54 @@ def books(update, context):
     page = 1
     per_page = 5
     shelf = 'etc'
+    cursor_id = None
     if not update.message:
-        logger.info(f"message: {update.callback_query.data}")
-        shelf = update.callback_query.data.split('_')[1]
-        page = int(update.callback_query.data.split('_')[2])
-        user_id = update.callback_query.from_user.id
+        query = update.callback_query
+        logger.info("message: %s", query.data)
+        user_id = query.from_user.id
+        if query.data.startswith('shelf_page '):
+            _, cursor_id, page = query.data.split(' ')
+            page = int(page)
+            cursor = cursors.get(cursor_id, user_id, 'shelf')
+            if cursor is None:
+                return query.answer("Список устарел, откройте полку заново")
+            shelf = cursor["params"]["shelf"]
+        else:
+            # "books_{shelf}_{page}", from the shelves list
+            shelf = query.data.split('_')[1]
+            page = int(query.data.split('_')[2])
     else:
-        logger.info(f"message: {update.message.text}")
+        logger.info("message: %s", update.message.text)
         user_id = update.message.from_user.id
 
-    logger.info((f"user_id: {user_id}, "
-                 f"shelf:{shelf}, "
-                 f" page:{page}"))
+    if cursor_id is None:
+        cursor_id = cursors.create(user_id, 'shelf', shelf=shelf)
+
+    logger.info("user_id: %s, shelf: %s, page: %s", user_id, shelf, page)
+    shelf_sync.touch(user_id)
 
     try:
         books = goodreads_api.get_books(user_id, page, per_page, shelf)
     except AuthError as ex:
-        logger.error(f"AuthError: user_id {user_id}")
+        logger.error("AuthError: user_id %s", user_id)
         return context.bot.send_message(user_id, text=str(ex))
+    stale = served_stale()
 
-    result = []
-    for book in books:
-        book['link'] = f"[→]({book['link']})"
-        book_md = (
-            f"*{strip_tags(book['title'])}* "
-            f"{book['link']}\n"
-            f"{', '.join(book['authors'])}\n"
-            f"/book\_{book['id']} "  # noqa
-        )
+    result = "\n\n".join(map(render.shelf_card, books)) if books else "*Это всё!*"
+    if stale:
+        result += STALE_NOTE
 
-        result.append(book_md)
-
-    result = "\n\n".join(result) if result else "*Это всё!*"
-
-    logger.info(str(result))
+    logger.debug("rendered %s books", len(books))
 
     buttons = [[]]
     if page > 1:
         buttons[0].append(
-            InlineKeyboardButton("⬅️", callback_data=f'books_{shelf}_{page-1}')
+            InlineKeyboardButton("⬅️", callback_data=f'shelf_page {cursor_id} {page-1}')
         )
 
     if len(books) == per_page:
         buttons[0].append(
-            InlineKeyboardButton("➡️", callback_data=f'books_{shelf}_{page+1}')
+            InlineKeyboardButton("➡️", callback_data=f'shelf_page {cursor_id} {page+1}')
         )
 
     buttons.append(
@@ -198,62 +263,36 @@ def books(update, context):
     else:
         update.message.reply_markdown(**params)
 
+    if len(books) == per_page:
+        prefetcher.schedule(user_id, goodreads_api.get_books,
+                            user_id, page + 1, per_page, shelf)
+
 
 def _book_buttons(shelf, book_id, user_id):
     shelves = goodreads_api.get_shelves(user_id)
 
-    shelves = {shelf['show_name']: shelf['name'] for shelf in shelves}
-    shelves['Remove 🗑'] = "remove" if shelf else None
-
-    buttons = []
-    for text, value in shelves.items():
-        if text != 'Remove 🗑':
-            button_text = text if shelf != value else f"{text} 📚"
-            callback_data = f'add_to_shelf {value} {book_id}'
-        elif bool(shelf):
-            button_text = 'Remove 🗑'
-            callback_data = f'rm_from_shelf {shelf} {book_id}'
-        else:
-            continue
-
-        button = [InlineKeyboardButton(button_text, callback_data=callback_data)]
-        buttons.append(button)
-
-    markup = InlineKeyboardMarkup(buttons)
-
-    return markup
-
-
-def _book_markdown(book):
-    book_md = (
-        f"*{book['title']}* \n"
-        f"{', '.join(book['authors'])}\n\n"
-    )
-    description = book.get('description')
-    if description:
-        book_md = book_md + f"{book['description'][:200]}... "
-
-    book_md = book_md + f"[На сайте 🌎]({book['link']})\n"
-
-    return strip_tags(book_md)
+    return render.book_keyboard(render.shelf_set(shelves), shelf, book_id)
 
 
 def book(update, context):
     user_id = update.message.from_user.id
     book_id = update.message.text.split('_')[1]
 
-    logger.info((f"user_id: {user_id}, "
-                 f"book_id:{book_id}"))
+    logger.info("user_id: %s, book_id: %s", user_id, book_id)
+    prefetcher.cancel(user_id)
 
     try:
         book = goodreads_api.get_book(user_id, book_id)
     except AuthError as ex:
-        logger.error(f"AuthError: user_id {user_id}")
+        logger.error("AuthError: user_id %s", user_id)
         return context.bot.send_message(user_id, text=str(ex))
+    stale = served_stale()
 
-    markup = _book_buttons(book.get('shelf'), book_id, user_id)
+    markup = _book_buttons(book.shelves[0] if book.shelves else None, book_id, user_id)
 
-    book_md = _book_markdown(book)
+    book_md = render.book_card(book)
+    if stale:
+        book_md += STALE_NOTE
 
     update.message.reply_text(text=book_md,
                               parse_mode=ParseMode.MARKDOWN,
@@ -262,23 +301,23 @@ def book(update, context):
 
 def add_to_shelf(update, context):
     query = update.callback_query
-    logger.info(f"query: {query}")
+    logger.debug("callback data: %s", query.data)
 
     shelf, book_id = query.data.split(' ')[1:3]
     user_id = query.from_user.id
 
     remove = "rm_from_shelf" in query.data
 
-    logger.info((f"user_id: {user_id}, "
-                 f"shelf:{shelf}, "
-                 f" book_id:{book_id}, "
-                 f" remove:{remove}"))
+    logger.info("user_id: %s, shelf: %s, book_id: %s, remove: %s",
+                user_id, shelf, book_id, remove)
+    prefetcher.cancel(user_id)
+    shelf_sync.touch(user_id)
 
     try:
         response_text = goodreads_api.add_to_shelf(user_id, shelf,
                                                    book_id, remove=remove)
     except (AuthError, ApiError) as ex:
-        logger.error(str(ex))
+        logger.error("%s", ex)
         return context.bot.send_message(user_id, str(ex))
 
     context.bot.answer_callback_query(query.id, response_text)
@@ -290,23 +329,150 @@ def add_to_shelf(update, context):
     update.callback_query.edit_message_reply_markup(reply_markup=markup)
 
 
+BULK_USAGE = (
+    "/move _полка_ _полка_ — переместить все книги с полки на другую\n"
+    "/move _полка_ _полка_ _id_ ... — переместить только эти книги\n"
+    "/add _полка_ _id_ ... — добавить книги на полку\n"
+    "/remove _полка_ [_id_ ...] — удалить книги, без _id_ — все книги полки, после подтверждения"
+)
+
+
+def bulk_shelf(update, context):
+    logger.info("message: %s", update.message.text)
+    user_id = update.message.from_user.id
+    command, *args = update.message.text.split()
+    command = command.lstrip('/').split('@')[0]
+
+    if command == 'move' and len(args) >= 2:
+        source, shelf, book_ids = args[0], args[1], args[2:]
+    elif command == 'remove' and args:
+        source, shelf, book_ids = args[0], args[0], args[1:]
+    elif command == 'add' and len(args) >= 2:
+        source, shelf, book_ids = None, args[0], args[1:]
+    else:
+        return update.message.reply_markdown(BULK_USAGE)
+    if not all(book_id.isdigit() for book_id in book_ids):
+        return update.message.reply_markdown(BULK_USAGE)
+
+    if command == 'remove' and not book_ids:
+        # a whole shelf is gone for good, ask first
+        cursor_id = cursors.create(user_id, 'bulk_remove', shelf=shelf)
+        markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("Удалить все 🗑", callback_data=f'bulk_remove {cursor_id}')
+        ]])
+        return update.message.reply_text(f"Удалить все книги с полки {shelf}?", reply_markup=markup)
+
+    _bulk_shelf(context, user_id, command, source, shelf, book_ids)
+
+
+def bulk_remove(update, context):
+    query = update.callback_query
+    logger.info("message: %s", query.data)
+    user_id = query.from_user.id
+
+    cursor_id = query.data.split(' ')[1]
+    cursor = cursors.get(cursor_id, user_id, 'bulk_remove')
+    if cursor is None:
+        return query.answer("Запрос устарел, отправьте /remove заново")
+    # one confirmation, one removal
+    cursors.discard(cursor_id)
+    query.answer()
+
+    shelf = cursor["params"]["shelf"]
+    _bulk_shelf(context, user_id, 'remove', shelf, shelf, [])
+
+
+def _bulk_shelf(context, user_id, command, source, shelf, book_ids):
+    remove = command == 'remove'
+
+    logger.info("user_id: %s, %s: %s -> %s, %s books",
+                user_id, command, source, shelf, len(book_ids) or 'all')
+    prefetcher.cancel(user_id)
+    shelf_sync.touch(user_id)
+
+    try:
+        if not book_ids:
+            book_ids = goodreads_api.shelf_book_ids(user_id, source, limit=BULK_MAX_BOOKS)
+        if len(book_ids) > BULK_MAX_BOOKS:
+            return context.bot.send_message(user_id, f"Не больше {BULK_MAX_BOOKS} книг за раз")
+        if not book_ids:
+            return context.bot.send_message(user_id, "На полке нет книг")
+
+        context.bot.send_message(user_id, f"Обрабатываю {len(book_ids)} книг…")
+        done, failed = goodreads_api.bulk_add_to_shelf(user_id, shelf, book_ids, remove=remove,
+                                                       source=source if command == 'move' else None)
+    except (AuthError, ApiError) as ex:
+        logger.error("%s", ex)
+        return context.bot.send_message(user_id, str(ex))
+
+    logger.info("user_id: %s, %s done, %s failed", user_id, len(done), len(failed))
+
+    text = f"Готово: {len(done)} из {len(book_ids)}"
+    if failed:
+        text += "\nНе получилось:\n" + "\n".join(
+            f"/book_{book_id}: {error}" for book_id, error in list(failed.items())[:10])
+        if len(failed) > 10:
+            text += f"\n… и ещё {len(failed) - 10}"
+    if command == 'move' and source in EXCLUSIVE_SHELVES and shelf not in EXCLUSIVE_SHELVES:
+        text += f"\nКниги остались и на полке {source}: с неё их можно только удалить"
+
+    context.bot.send_message(user_id, text)
+
+
+def export_shelf(update, context):
+    logger.info("message: %s", update.message.text)
+    user_id = update.message.from_user.id
+
+    # /export [shelf] [csv|json], every shelf by default
+    shelf, fmt = None, 'csv'
+    for arg in update.message.text.split()[1:]:
+        if arg.lower() in export.FORMATS:
+            fmt = arg.lower()
+        else:
+            shelf = arg
+
+    logger.info("user_id: %s, export shelf: %s, format: %s", user_id, shelf, fmt)
+    prefetcher.cancel(user_id)
+
+    update.message.reply_text("Собираю книги, это может занять время…")
+    context.bot.send_chat_action(user_id, ChatAction.UPLOAD_DOCUMENT)
+    try:
+        document, count = export.export(user_id, shelf, fmt)
+    except (AuthError, ApiError) as ex:
+        logger.error("%s", ex)
+        return context.bot.send_message(user_id, str(ex))
+
+    logger.info("user_id: %s, exported %s books", user_id, count)
+
+    with document:
+        if not count:
+            return update.message.reply_text("На полке нет книг")
+
+        context.bot.send_document(user_id, document=document,
+                                  filename=f"goodreads-{shelf or 'all'}.{fmt}",
+                                  caption=f"Книг: {count}")
+
+
 def inlinebook(update, context):
     user_id = update.callback_query.from_user.id
     book_id = update.callback_query.data.split(' ')[1]
 
-    logger.info((f"user_id: {user_id}, "
-                 f"book_id:{book_id}, "
-                 f"query: {update.callback_query.data}"))
+    logger.info("user_id: %s, book_id: %s, query: %s",
+                user_id, book_id, update.callback_query.data)
+    prefetcher.cancel(user_id)
 
     try:
         book = goodreads_api.get_book(user_id, book_id)
     except AuthError as ex:
-        logger.error(f"AuthError: user_id {user_id}")
+        logger.error("AuthError: user_id %s", user_id)
         return context.bot.send_message(user_id, text=str(ex))
+    stale = served_stale()
 
-    markup = _book_buttons(book.get('shelf'), book_id, user_id)
+    markup = _book_buttons(book.shelves[0] if book.shelves else None, book_id, user_id)
 
-    book_md = _book_markdown(book)
+    book_md = render.book_card(book)
+    if stale:
+        book_md += STALE_NOTE
 
     context.bot.send_message(user_id,
                              text=book_md,
@@ -319,12 +485,25 @@ def inlinequery(update, context):
     user_id = update.inline_query.from_user.id
     page = int(update.inline_query.offset or 1)
 
-    logger.info(f"query: {query}, page: {page}")
+    inline_logger.info("query: %s, page: %s", query, page)
+
+    generation = inline_queries.begin(user_id)
+    try:
+        _inlinequery(update, user_id, query, page, generation)
+    finally:
+        inline_queries.finish(user_id, generation)
+
+
+def _inlinequery(update, user_id, query, page, generation):
+    # the user kept typing, this query is already outdated
+    if not inline_queries.wait(user_id, generation):
+        return
 
     try:
-        books = goodreads_api.get_search_books(user_id, query, page=page, per_page=20)
+        with priority(SEARCH):
+            books = goodreads_api.get_search_books(user_id, query, page=page, per_page=20)
     except AuthError:
-        logger.error(f"AuthError: user_id {user_id}")
+        logger.error("AuthError: user_id %s", user_id)
         result = [(
             InlineQueryResultArticle(
                 id=uuid4(),
@@ -336,31 +515,20 @@ def inlinequery(update, context):
 
         return update.inline_query.answer(result, cache_time=0, switch_pm_text="Добавить бота", switch_pm_parameter="f")
 
-    result = []
-    for index, book in enumerate(books):
-        book_md = (
-            f"*{strip_tags(book['title'])}* \n"
-            f"{', '.join(book['authors'])}\n"
-            f"[На сайте 🌎](https://www.goodreads.com/book/show/{book['id']})"
-        )
+    if not inline_queries.still_current(user_id, generation):
+        return
 
-        add_book_button = InlineKeyboardButton("Добавить книгу 📚", callback_data=f"inlinebook {book['id']}")
-        result.append(
-            InlineQueryResultArticle(
-                id=uuid4(),
-                title=strip_tags(book["title"]),
-                thumb_url=book["image_url"],
-                description=f"{', '.join(book['authors'])}",
-                input_message_content=InputTextMessageContent(
-                    book_md,
-                    ParseMode.MARKDOWN
-                ),
-                reply_markup=InlineKeyboardMarkup([[add_book_button]])
-            )
-        )
+    if page == 1:
+        books = _with_library(user_id, query, books)
+
+    result = [InlineQueryResultArticle(id=uuid4(), **render.inline_card(book)) for book in books]
 
     update.inline_query.answer(result, next_offset=page + 1)
 
+    if books:
+        prefetcher.schedule(user_id, goodreads_api.get_search_books,
+                            user_id, query, page=page + 1, per_page=20)
+
 
 # TODO: prevent multiple /autorize
 def authorize(update, context):
@@ -370,15 +538,14 @@ def authorize(update, context):
     authorize_url = goodreads_service.get_authorize_url(req_token)
 
     user_id = update.message.from_user.id
-    with conn.cursor() as cur:
+    with pool.cursor() as cur:
         cur.execute("INSERT INTO tokens (id, request_token, "
                     "                     request_token_secret) "
                     "VALUES(%s, %s, %s)"
                     "ON CONFLICT DO NOTHING", (user_id, req_token,
                                                req_token_secret))
-    conn.commit()
 
-    logger.info(f"Authorize, sending url to user: {str(user_id)}")
+    logger.info("Authorize, sending url to user: %s", user_id)
 
     markup = InlineKeyboardMarkup(
         [[InlineKeyboardButton('Готово!', callback_data='check_auth')]]
@@ -393,7 +560,7 @@ def check_auth(update, context):
     query = update.callback_query
     user_id = query.from_user.id
 
-    with conn.cursor() as cur:
+    with pool.cursor() as cur:
         cur.execute("SELECT request_token, request_token_secret "
                     "FROM tokens where id = %s", (user_id,))
         tokens = cur.fetchone()
@@ -401,14 +568,14 @@ def check_auth(update, context):
     try:
         session = goodreads_service.get_auth_session(*tokens)
     except KeyError:
-        logger.error(f"authorize error: user_id {user_id}")
+        logger.error("authorize error: user_id %s", user_id)
         context.bot.answer_callback_query(query.id, "Ошибка авторизации!")
         return
 
     goodreads_id = goodreads_api.me(session)
 
-    logger.info(f"Success auth, user_id: {user_id}")
-    with conn.cursor() as cur:
+    logger.info("Success auth, user_id: %s", user_id)
+    with pool.cursor() as cur:
         cur.execute("UPDATE tokens "
                     "SET (access_token, access_token_secret, "
                     "     goodreads_id) = (%s, %s, %s) "
@@ -416,7 +583,8 @@ def check_auth(update, context):
                                       session.access_token_secret,
                                       goodreads_id,
                                       user_id))
-    conn.commit()
+    goodreads_api.forget_user(user_id)
+    shelf_sync.request(user_id)
 
     message = ("""Авторизация успешна 🚀\n"""
                """Для начала работы просто попробуйте отправить боту название книги 📖\n"""
@@ -425,15 +593,15 @@ def check_auth(update, context):
 
 
 def logout(update, context):
-    logger.info(f"message: {update.message.text}")
+    logger.info("message: %s", update.message.text)
     user_id = update.message.from_user.id
 
-    with conn.cursor() as cur:
+    with pool.cursor() as cur:
         cur.execute("DELETE FROM tokens "
                     "where id = %s "
                     "RETURNING id", [user_id])
         count = cur.fetchone()
-    conn.commit()
+    goodreads_api.forget_user(user_id)
 
     if not count:
         return start_handler(update, context)
@@ -445,59 +613,157 @@ def logout(update, context):
     update.message.reply_text(text=text)
 
 
-updater = Updater(TELEGRAM_BOT_TOKEN)
+def error_handler(update, context):
+    if not isinstance(context.error, UPSTREAM_ERRORS):
+        logger.error("update %s caused an error", getattr(update, 'update_id', None),
+                     exc_info=context.error)
+        return
 
-updater.dispatcher.add_handler(CommandHandler('start', start_handler))
+    # goodreads.com is failing and there was nothing cached to answer with
+    logger.warning("goodreads.com: %r", context.error)
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        context.bot.send_message(chat.id, "Goodreads сейчас не отвечает, попробуйте позже")
 
-updater.dispatcher.add_handler(CommandHandler('authorize', authorize))
-updater.dispatcher.add_handler(
-    CallbackQueryHandler(check_auth, pattern='check_auth')
-)
 
-updater.dispatcher.add_handler(CommandHandler('shelves', shelves))
-updater.dispatcher.add_handler(
-    CallbackQueryHandler(shelves, pattern='shelves')
-)
+def add_handlers(dispatcher):
+    dispatcher.add_handler(CommandHandler('start', start_handler))
 
-updater.dispatcher.add_handler(CommandHandler('books', books))
-updater.dispatcher.add_handler(
-    CallbackQueryHandler(books, pattern='books_')
-)
+    # handlers that wait on goodreads.com or Postgres run on the worker pool,
+    # so one slow upstream response doesn't stall the dispatcher thread
+    dispatcher.add_handler(CommandHandler('authorize', authorize, run_async=True))
+    dispatcher.add_handler(
+        CallbackQueryHandler(check_auth, pattern='check_auth', run_async=True)
+    )
 
-updater.dispatcher.add_handler(
-    MessageHandler(Filters.regex(r'^/book_\d*$'), book)
-)
+    dispatcher.add_handler(CommandHandler('shelves', shelves, run_async=True))
+    dispatcher.add_handler(
+        CallbackQueryHandler(shelves, pattern='shelves', run_async=True)
+    )
 
-updater.dispatcher.add_handler(
-    CallbackQueryHandler(add_to_shelf, pattern='add_to_shelf')
-)
+    dispatcher.add_handler(CommandHandler('books', books, run_async=True))
+    dispatcher.add_handler(
+        CallbackQueryHandler(books, pattern='books_', run_async=True)
+    )
+    dispatcher.add_handler(
+        CallbackQueryHandler(books, pattern='shelf_page', run_async=True)
+    )
 
-updater.dispatcher.add_handler(
-    CallbackQueryHandler(add_to_shelf, pattern='rm_from_shelf')
-)
+    dispatcher.add_handler(
+        MessageHandler(Filters.regex(r'^/book_\d*$'), book, run_async=True)
+    )
 
-updater.dispatcher.add_handler(
-    CallbackQueryHandler(inlinebook, pattern='inlinebook')
-)
+    dispatcher.add_handler(
+        CallbackQueryHandler(add_to_shelf, pattern='add_to_shelf', run_async=True)
+    )
+
+    dispatcher.add_handler(
+        CallbackQueryHandler(add_to_shelf, pattern='rm_from_shelf', run_async=True)
+    )
+
+    dispatcher.add_handler(
+        CallbackQueryHandler(inlinebook, pattern='inlinebook', run_async=True)
+    )
+
+    dispatcher.add_handler(
+        CommandHandler(['move', 'add', 'remove'], bulk_shelf, run_async=True)
+    )
+    dispatcher.add_handler(
+        CallbackQueryHandler(bulk_remove, pattern='bulk_remove ', run_async=True)
+    )
 
-updater.dispatcher.add_handler(CommandHandler('logout', logout))
+    dispatcher.add_handler(CommandHandler('export', export_shelf, run_async=True))
 
-updater.dispatcher.add_handler(InlineQueryHandler(inlinequery))
+    dispatcher.add_handler(CommandHandler('logout', logout, run_async=True))
 
-updater.dispatcher.add_handler(CommandHandler('search_books', search_books))
-updater.dispatcher.add_handler(
-    CallbackQueryHandler(search_books, pattern='search_books')
-)
-updater.dispatcher.add_handler(
-    MessageHandler(Filters.text, callback=search_books)
-)
+    dispatcher.add_handler(InlineQueryHandler(inlinequery, run_async=True))
+
+    dispatcher.add_handler(CommandHandler('search_books', search_books, run_async=True))
+    dispatcher.add_handler(
+        CallbackQueryHandler(search_books, pattern='search_books', run_async=True)
+    )
+    dispatcher.add_handler(
+        CallbackQueryHandler(search_books, pattern='search_page', run_async=True)
+    )
+    dispatcher.add_handler(
+        MessageHandler(Filters.text, callback=search_books, run_async=True)
+    )
+
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            handler.callback = metrics.instrument_handler(logs.correlated(handler.callback))
+
+    dispatcher.add_error_handler(error_handler)
+
+
+def add_lanes(dispatcher):
+    # after add_handlers and anything else wrapping the callbacks; inline
+    # queries have LatestOnly and would only queue behind their debounce
+    if USER_LANES:
+        user_lanes.install(dispatcher, exclude=(InlineQueryHandler,))
+
+
+def register_metrics(dispatcher):
+    registry = metrics.registry
+    registry.stats("cache", "cache", {
+        "sessions": sessions_cache,
+        "shelves": shelves_cache,
+        "shelf_state": shelf_state_cache,
+        "book_pages": book_pages_cache,
+        "books": books_cache,
+        "search": search_cache,
+        "libraries": libraries,
+        "cursors": cursors,
+    })
+    registry.stats("render_cache", "name", {"cards": render})
+    registry.stats("l2_cache", "store", {"postgres": tiered.store})
+    registry.stats("db_pool", "pool", {"postgres": pool})
+    registry.stats("http_pool", "pool", {"goodreads": adapter})
+    registry.stats("ratelimit", "scheduler", {"upstream": scheduler})
+    registry.stats("single_flight", "name", {"search": search_flight})
+    registry.stats("latest_only", "name", {"inline_queries": inline_queries})
+    registry.stats("lanes", "name", {"users": user_lanes})
+    registry.stats("prefetch", "name", {"next_page": prefetcher, "revalidate": revalidator})
+    registry.stats("breaker", "name", {"goodreads": breaker})
+    registry.stats("shelf_sync", "name", {"mirror": shelf_sync})
+    registry.stats("logging", "name", {"pipeline": logs.pipeline})
+    registry.stats("dispatcher", "name", {"updater": lambda: {
+        "update_queue": dispatcher.update_queue.qsize(),
+        # run_async jobs waiting for a free worker, private in PTB 13
+        "worker_queue": dispatcher._Dispatcher__async_queue.qsize(),
+        "workers": len(dispatcher._Dispatcher__async_threads),
+    }})
+
+
+def main():
+    logs.pipeline.start()
+
+    updater = Updater(TELEGRAM_BOT_TOKEN, workers=DISPATCHER_WORKERS)
+    add_handlers(updater.dispatcher)
+    add_lanes(updater.dispatcher)
+    register_metrics(updater.dispatcher)
+
+    # a bounded share of the previous run's caches, so it doesn't start cold
+    warmed = tiered.store.warm_up([shelves_cache, books_cache, search_cache])
+    logger.info("warmed %s cache entries from Postgres", warmed)
+
+    shelf_sync.start()
+
+    if os.environ.get("HEROKU"):
+        updater.start_webhook(listen="0.0.0.0",
+                              port=PORT,
+                              url_path=TELEGRAM_BOT_TOKEN)
+        updater.bot.set_webhook(f"{APP_URL}/{TELEGRAM_BOT_TOKEN}")
+        # /metrics next to the webhook, it's the only port Heroku routes
+        metrics.add_to_webhook(updater)
+    else:
+        updater.start_polling()
+        metrics.serve(PORT)
+
+    updater.idle()
+    tiered.store.stop()
+    logs.pipeline.stop()
 
-if os.environ.get("HEROKU"):
-    updater.start_webhook(listen="0.0.0.0",
-                          port=PORT,
-                          url_path=TELEGRAM_BOT_TOKEN)
-    updater.bot.set_webhook(f"{APP_URL}/{TELEGRAM_BOT_TOKEN}")
-else:
-    updater.start_polling()
 
-updater.idle()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from config import (BREAKER_FAILURE_RATIO, BREAKER_MIN_CALLS,
+                    BREAKER_OPEN_SECONDS, BREAKER_SLOW_CALL, BREAKER_WINDOW)
+from metrics import breaker_transitions
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+STATES = (CLOSED, HALF_OPEN, OPEN)
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker():
+    # Fails goodreads.com calls fast once too many of the recent ones failed
+    # or were slower than `slow_call`. After `open_for` seconds a single
+    # probe goes through: its success closes the circuit, a failure opens
+    # it again.
+
+    def __init__(self, window, min_calls, failure_ratio, slow_call, open_for):
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_call = slow_call
+        self.open_for = open_for
+
+        self._lock = threading.Lock()
+        # True for a failed or slow call
+        self._outcomes = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._rejected = 0
+
+    @property
+    def state(self):
+        return self._state
+
+    def before(self):
+        # raises CircuitOpen instead of letting a request through
+        with self._lock:
+            if self._state == CLOSED:
+                return
+
+            if self._state == OPEN:
+                if time.monotonic() < self._opened_at + self.open_for:
+                    self._rejected += 1
+                    raise CircuitOpen("Goodreads сейчас не отвечает, попробуйте позже")
+                self._transition(HALF_OPEN)
+
+            if self._probing:
+                self._rejected += 1
+                raise CircuitOpen("Goodreads сейчас не отвечает, попробуйте позже")
+            self._probing = True
+
+    def record(self, seconds, failed=False, slow_call=None):
+        # `slow_call` overrides the breaker's own threshold for this call
+        failed = failed or seconds >= (self.slow_call if slow_call is None else slow_call)
+
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probing = False
+                self._transition(OPEN if failed else CLOSED)
+                return
+
+            if self._state == OPEN:
+                # started before the circuit opened
+                return
+
+            self._outcomes.append(failed)
+            if len(self._outcomes) >= self.min_calls and \
+                    sum(self._outcomes) >= self.failure_ratio * len(self._outcomes):
+                self._transition(OPEN)
+
+    def _transition(self, state):
+        logger.warning("goodreads circuit %s -> %s, %s of the last %s calls failed",
+                       self._state, state, sum(self._outcomes), len(self._outcomes))
+
+        self._state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        elif state == CLOSED:
+            self._outcomes.clear()
+
+        breaker_transitions.labels(state).inc()
+
+    def wait(self):
+        # sleeps until a probe may go through, for background refreshes
+        with self._lock:
+            delay = self._opened_at + self.open_for - time.monotonic() \
+                if self._state == OPEN else 0
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": STATES.index(self._state),
+                "rejected": self._rejected,
+                "recent_calls": len(self._outcomes),
+                "recent_failures": sum(self._outcomes),
+            }
+
+
+breaker = CircuitBreaker(BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_FAILURE_RATIO,
+                         BREAKER_SLOW_CALL, BREAKER_OPEN_SECONDS)
@@ -0,0 +1,133 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def sizeof(obj):
+    # Rough deep size of the plain containers we cache
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(k) + sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(sizeof(item) for item in obj)
+
+    return size
+
+
+class TTLCache():
+    # Thread-safe LRU cache with per-entry expiry. Least recently used
+    # entries are evicted once maxsize entries, or max_bytes as measured
+    # by `sizeof`, is reached. With `stale_ttl`, expired entries are kept
+    # that much longer for get_stale().
+
+    def __init__(self, maxsize=1024, ttl=300, max_bytes=None, sizeof=sizeof, stale_ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.stale_ttl = stale_ttl
+
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+            "stale_hits": 0,
+        }
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return default
+
+            expires_at, value, size = entry
+            now = time.monotonic()
+            if expires_at <= now:
+                if expires_at + self.stale_ttl <= now:
+                    del self._data[key]
+                    self._bytes -= size
+                    self._counters["expirations"] += 1
+                self._counters["misses"] += 1
+                return default
+
+            self._data.move_to_end(key)
+            self._counters["hits"] += 1
+
+            return value
+
+    def get_stale(self, key, default=None):
+        # the value even if it expired, as long as it is within stale_ttl
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] + self.stale_ttl <= time.monotonic():
+                return default
+
+            self._counters["stale_hits"] += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        size = self.sizeof(value) if self.max_bytes else 0
+
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[2]
+
+            self._data[key] = (expires_at, value, size)
+            self._bytes += size
+
+            while len(self._data) > self.maxsize or \
+                    (self.max_bytes and self._bytes > self.max_bytes and len(self._data) > 1):
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self._bytes -= evicted_size
+                self._counters["evictions"] += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+
+            self._bytes -= entry[2]
+            self._counters["invalidations"] += 1
+            return entry[1]
+
+    def discard(self, predicate):
+        # drops every entry whose key matches, O(size)
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self._bytes -= self._data.pop(key)[2]
+            self._counters["invalidations"] += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def keys(self):
+        # snapshot, expired entries included until they are looked up
+        with self._lock:
+            return list(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["size"] = len(self._data)
+            stats["bytes"] = self._bytes
+
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+
+        return stats
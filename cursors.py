@@ -0,0 +1,62 @@
+import secrets
+
+from cache import TTLCache
+from config import (CURSOR_CACHE_MAX_BYTES, CURSOR_CACHE_SIZE,
+                    CURSOR_CACHE_TTL, CURSOR_WINDOW)
+
+
+class CursorStore():
+    # Pagination state kept server side, so callback_data only carries a
+    # short id and a page number and stays well under Telegram's 64 bytes.
+    # A cursor holds its parameters and the last `window` pages it served.
+
+    def __init__(self, maxsize=CURSOR_CACHE_SIZE, ttl=CURSOR_CACHE_TTL,
+                 max_bytes=CURSOR_CACHE_MAX_BYTES, window=CURSOR_WINDOW):
+        self.window = window
+        self._cursors = TTLCache(maxsize=maxsize, ttl=ttl, max_bytes=max_bytes)
+
+    def create(self, user_id, kind, **params):
+        # 8 url-safe characters
+        cursor_id = secrets.token_urlsafe(6)
+        self._cursors.set(cursor_id, {
+            "user_id": user_id,
+            "kind": kind,
+            "params": params,
+            "pages": {},
+        })
+
+        return cursor_id
+
+    def get(self, cursor_id, user_id, kind):
+        cursor = self._cursors.get(cursor_id)
+        if cursor is None or cursor["user_id"] != user_id or cursor["kind"] != kind:
+            return None
+
+        return cursor
+
+    def page(self, cursor, page):
+        return cursor["pages"].get(page)
+
+    def save_page(self, cursor_id, cursor, page, items):
+        # copied, another thread may be measuring or reading the old one
+        pages = dict(cursor["pages"])
+        pages[page] = items
+        while len(pages) > self.window:
+            # drop the page furthest from the one just served
+            del pages[max(pages, key=lambda number: abs(number - page))]
+        cursor["pages"] = pages
+
+        # stored again so the size accounting and the expiry follow the use
+        self._cursors.set(cursor_id, cursor)
+
+    def discard(self, cursor_id):
+        self._cursors.pop(cursor_id)
+
+    def clear(self):
+        self._cursors.clear()
+
+    def stats(self):
+        return self._cursors.stats()
+
+
+cursors = CursorStore()
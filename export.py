@@ -0,0 +1,118 @@
+import csv
+import io
+import json
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from api import goodreads_api
+from config import EXPORT_PER_PAGE, EXPORT_WORKERS
+from ratelimit import PREFETCH, current_priority, priority
+
+FIELDS = ('id', 'title', 'authors', 'publication_year', 'link',
+          'shelves', 'date_added', 'date_updated')
+FORMATS = ('csv', 'json')
+
+
+def pages(fetch, per_page, workers):
+    # Yields fetch(1), fetch(2), ... in order, keeping `workers` pages in
+    # flight and at most that many in memory, until a short page.
+    level = current_priority()
+
+    def run(page):
+        with priority(level):
+            return fetch(page)
+
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix='export') as executor:
+        pending = deque()
+        next_page = 1
+        last = False
+        try:
+            while True:
+                while not last and len(pending) < workers:
+                    pending.append(executor.submit(run, next_page))
+                    next_page += 1
+                if not pending:
+                    return
+
+                items = pending.popleft().result()
+                if len(items) < per_page:
+                    # the pages already requested after it are empty
+                    last = True
+                if items:
+                    yield items
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def rows(user_id, shelf=None, per_page=EXPORT_PER_PAGE, workers=EXPORT_WORKERS):
+    # oldest first, books added during the export only append pages
+    def fetch(page):
+        return goodreads_api.get_reviews(user_id, page, per_page, shelf=shelf,
+                                         sort="date_added", order="a")
+
+    for reviews in pages(fetch, per_page, workers):
+        for review in reviews:
+            book = review['book']
+            yield {
+                'id': book.id,
+                'title': book.title,
+                'authors': [author.name for author in book.authors],
+                'publication_year': book.publication_year,
+                'link': book.link,
+                'shelves': review['shelves'],
+                'date_added': _isoformat(review['date_added']),
+                'date_updated': _isoformat(review['date_updated']),
+            }
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+def write_csv(rows, output):
+    writer = csv.writer(output)
+    writer.writerow(FIELDS)
+
+    count = 0
+    for row in rows:
+        writer.writerow([", ".join(value) if isinstance(value, list) else value
+                         for value in (row[field] for field in FIELDS)])
+        count += 1
+
+    return count
+
+
+def write_json(rows, output):
+    count = 0
+    output.write("[")
+    for row in rows:
+        output.write(",\n " if count else "\n ")
+        json.dump(row, output, ensure_ascii=False)
+        count += 1
+    output.write("\n]\n")
+
+    return count
+
+
+def export(user_id, shelf=None, fmt='csv'):
+    # (binary file positioned at the start, number of books); rows go
+    # straight to a temporary file as the pages arrive
+    output = tempfile.TemporaryFile()
+    text = io.TextIOWrapper(output, encoding='utf-8', newline='')
+    try:
+        write = write_json if fmt == 'json' else write_csv
+        # behind everyone's interactive calls, the pages are fetched ahead
+        with priority(PREFETCH):
+            count = write(rows(user_id, shelf), text)
+        text.flush()
+    except BaseException:
+        text.close()
+        raise
+
+    text.detach()
+    output.seek(0)
+
+    return output, count
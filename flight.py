@@ -0,0 +1,111 @@
+import threading
+from itertools import count
+
+
+class _Call():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    # Concurrent calls with the same key share one execution: the first
+    # caller runs `func`, the rest wait for and reuse its result or error.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = {"calls": 0, "shared": 0}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._counters["calls"] += 1
+            else:
+                self._counters["shared"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["in_flight"] = len(self._calls)
+
+        return stats
+
+
+class LatestOnly():
+    # Keeps track of the newest request per user. A request waits out the
+    # debounce window first and is released early (as superseded) as soon
+    # as a newer one from the same user arrives.
+
+    def __init__(self, debounce=0.0):
+        self.debounce = debounce
+
+        self._lock = threading.Lock()
+        self._generations = count(1)
+        self._current = {}
+        self._counters = {"started": 0, "superseded": 0}
+
+    def begin(self, user_id):
+        with self._lock:
+            previous = self._current.get(user_id)
+            if previous is not None:
+                previous[1].set()
+
+            generation = next(self._generations)
+            self._current[user_id] = (generation, threading.Event())
+            self._counters["started"] += 1
+
+        return generation
+
+    def is_current(self, user_id, generation):
+        current = self._current.get(user_id)
+        return current is not None and current[0] == generation
+
+    def wait(self, user_id, generation):
+        current = self._current.get(user_id)
+        if self.debounce and current is not None and current[0] == generation:
+            current[1].wait(self.debounce)
+
+        return self.still_current(user_id, generation)
+
+    def still_current(self, user_id, generation):
+        if self.is_current(user_id, generation):
+            return True
+
+        with self._lock:
+            self._counters["superseded"] += 1
+        return False
+
+    def finish(self, user_id, generation):
+        with self._lock:
+            if self.is_current(user_id, generation):
+                del self._current[user_id]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["pending"] = len(self._current)
+
+        return stats
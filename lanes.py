@@ -0,0 +1,102 @@
+import threading
+from collections import deque
+
+from cache import TTLCache
+from config import CALLBACK_DEDUPE_WINDOW
+from metrics import lane_depth
+
+
+class UserLanes():
+    # Runs one user's updates one at a time, in the order the dispatcher
+    # handed them over, while different users still run in parallel on the
+    # worker pool. Updates are queued from the dispatcher thread, so the
+    # order is the update order; the first one of an idle lane starts a job
+    # that drains it. A callback query repeating the user's previous one
+    # within `window` seconds, a double tap, is dropped.
+
+    def __init__(self, window=CALLBACK_DEDUPE_WINDOW, max_users=10000):
+        self.window = window
+
+        self._lock = threading.Lock()
+        self._lanes = {}
+        self._last_callback = TTLCache(maxsize=max_users, ttl=window)
+        self._counters = {"updates": 0, "duplicates": 0, "peak_depth": 0}
+
+    def install(self, dispatcher, exclude=()):
+        # takes over the run_async handlers, `exclude` handler types keep
+        # running side by side
+        for handlers in dispatcher.handlers.values():
+            for handler in handlers:
+                if handler.run_async and not isinstance(handler, exclude):
+                    handler.callback = self.wrap(handler.callback, dispatcher)
+                    handler.run_async = False
+
+    def wrap(self, callback, dispatcher):
+        # the returned callback only queues, it runs on the dispatcher thread
+        def wrapper(update, context):
+            user = update.effective_user
+            if user is None:
+                return dispatcher.run_async(callback, update, context, update=update)
+            if self._duplicate(user.id, update.callback_query):
+                # stops the spinner on the tapped button, off this thread
+                return dispatcher.run_async(update.callback_query.answer, update=update)
+
+            self.submit(dispatcher, user.id, callback, update, context)
+
+        wrapper.__name__ = callback.__name__
+        return wrapper
+
+    def _duplicate(self, user_id, query):
+        if query is None or not self.window:
+            return False
+
+        with self._lock:
+            previous = self._last_callback.get(user_id)
+            # every tap restarts the window, a burst is dropped as a whole
+            self._last_callback.set(user_id, query.data)
+            if previous != query.data:
+                return False
+            self._counters["duplicates"] += 1
+
+        return True
+
+    def submit(self, dispatcher, user_id, callback, update, context):
+        with self._lock:
+            lane = self._lanes.get(user_id)
+            idle = lane is None
+            if idle:
+                lane = self._lanes[user_id] = deque()
+            depth = len(lane)
+            lane.append((callback, update, context))
+
+            self._counters["updates"] += 1
+            self._counters["peak_depth"] = max(self._counters["peak_depth"], depth + 1)
+
+        lane_depth.observe(depth)
+        if idle:
+            dispatcher.run_async(self._drain, dispatcher, user_id, lane, update=update)
+
+    def _drain(self, dispatcher, user_id, lane):
+        while True:
+            with self._lock:
+                if not lane:
+                    del self._lanes[user_id]
+                    return
+                callback, update, context = lane.popleft()
+
+            try:
+                callback(update, context)
+            except Exception as ex:
+                # what run_async would have done, and the lane goes on
+                dispatcher.dispatch_error(update, ex)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            depths = [len(lane) for lane in self._lanes.values()]
+
+        stats["lanes"] = len(depths)
+        stats["queued"] = sum(depths)
+        stats["max_depth"] = max(depths, default=0)
+
+        return stats
@@ -0,0 +1,133 @@
+import heapq
+import re
+import threading
+from bisect import bisect_left, insort
+
+from models import shelf_name
+
+WORD_RE = re.compile(r"\w+")
+
+# a shorter word alone only matches whole words, "a" would match everything
+MIN_PREFIX = 3
+
+# a book is on at most one of these, adding it to one moves it
+EXCLUSIVE_SHELVES = ('read', 'currently-reading', 'to-read')
+
+
+def tokenize(text):
+    return WORD_RE.findall(text.casefold()) if text else []
+
+
+class LibraryIndex():
+    # One user's shelved books, searchable by word prefixes of the title
+    # and author names. Postings map every word to the books containing
+    # it, the sorted word list turns a prefix into a range of words.
+
+    def __init__(self, complete=False):
+        # complete: built from the whole library, not just the pages seen
+        self.complete = complete
+
+        self._lock = threading.Lock()
+        self._books = {}
+        self._book_words = {}
+        self._postings = {}
+        self._words = []
+
+    def __len__(self):
+        return len(self._books)
+
+    def _words_of(self, book):
+        return tuple(set(tokenize(book.title)).union(*(tokenize(author.name) for author in book.authors)))
+
+    def _unindex(self, book_id):
+        book = self._books.pop(book_id, None)
+        if book is None:
+            return None
+
+        for word in self._book_words.pop(book_id):
+            postings = self._postings[word]
+            postings.discard(book_id)
+            if not postings:
+                del self._postings[word]
+                del self._words[bisect_left(self._words, word)]
+
+        return book
+
+    def _index(self, book):
+        words = self._words_of(book)
+        self._books[book.id] = book
+        self._book_words[book.id] = words
+        for word in words:
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = set()
+                insort(self._words, word)
+            postings.add(book.id)
+
+    def add(self, book, shelf):
+        book_id = str(book.id)
+
+        with self._lock:
+            previous = self._unindex(book_id)
+            shelves = set(previous.shelves) if previous else set()
+            if shelf in EXCLUSIVE_SHELVES:
+                shelves.difference_update(EXCLUSIVE_SHELVES)
+            shelves.add(shelf_name(shelf))
+
+            # the description is never shown for library matches
+            self._index(book._replace(id=book_id, description=None,
+                                      shelves=tuple(sorted(shelves))))
+
+    def shelves_of(self, book_id):
+        with self._lock:
+            book = self._books.get(str(book_id))
+        return book.shelves if book is not None else ()
+
+    def remove(self, book_id, shelf):
+        book_id = str(book_id)
+
+        with self._lock:
+            book = self._unindex(book_id)
+            if book is None or shelf in EXCLUSIVE_SHELVES:
+                # off its exclusive shelf a book leaves the library
+                return
+
+            shelves = tuple(name for name in book.shelves if name != shelf)
+            if shelves:
+                self._index(book._replace(shelves=shelves))
+
+    def _matching(self, prefix):
+        if len(prefix) < MIN_PREFIX:
+            return set(self._postings.get(prefix, ()))
+
+        matches = set()
+        index = bisect_left(self._words, prefix)
+        while index < len(self._words) and self._words[index].startswith(prefix):
+            matches |= self._postings[self._words[index]]
+            index += 1
+
+        return matches
+
+    def _has(self, book_id, prefix):
+        return any(word.startswith(prefix) for word in self._book_words[book_id])
+
+    def search(self, query, limit=5):
+        words = tokenize(query)
+        if not words:
+            return []
+
+        # the longest word is usually the most selective, the candidates it
+        # matches are then checked against the other words directly
+        first, *rest = sorted(set(words), key=len, reverse=True)
+        with self._lock:
+            matches = self._matching(first)
+            for word in rest:
+                matches = {book_id for book_id in matches if self._has(book_id, word)}
+
+            books = [self._books[book_id] for book_id in matches]
+
+        # titles starting with the query first, then shorter ones
+        query = " ".join(words)
+        return heapq.nsmallest(limit, books,
+                               key=lambda book: (not book.title.casefold().startswith(query),
+                                                 len(book.title), book.id))
@@ -0,0 +1,133 @@
+import logging
+import random
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+
+from config import LOG_LEVEL, LOG_LEVELS, LOG_QUEUE_SIZE
+
+LOG_FORMAT = ("%(filename)s[LINE:%(lineno)d]# - "
+              "%(asctime)s - "
+              "%(funcName)s: "
+              "[%(update_id)s] "
+              "%(message)s")
+
+_local = threading.local()
+
+
+def correlated(callback):
+    # tags every record logged while handling an update with its id
+    def wrapper(update, context):
+        previous = getattr(_local, 'update_id', None)
+        _local.update_id = getattr(update, 'update_id', None)
+        try:
+            return callback(update, context)
+        finally:
+            _local.update_id = previous
+
+    wrapper.__name__ = callback.__name__
+    return wrapper
+
+
+class UpdateIdFilter(logging.Filter):
+    def filter(self, record):
+        update_id = getattr(_local, 'update_id', None)
+        record.update_id = '-' if update_id is None else update_id
+        return True
+
+
+class SampledLogger():
+    # Keeps only `rate` of the info/debug calls. The decision is made before
+    # a record is created, which is most of the cost of a log call, so the
+    # sampled out ones are nearly free.
+
+    sampled_out = 0
+
+    def __init__(self, logger, rate):
+        self.logger = logger
+        self.rate = rate
+
+    def log(self, level, msg, *args, **kwargs):
+        if not self.logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING and random.random() >= self.rate:
+            SampledLogger.sampled_out += 1
+            return
+
+        # report the caller of debug()/info(), not this method
+        self.logger.log(level, msg, *args, stacklevel=3, **kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+
+class BoundedQueueHandler(QueueHandler):
+    # Hands records to the listener thread without formatting them, and
+    # drops them rather than block the update when the queue is full.
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # formatting happens on the listener thread
+        return record
+
+
+class LogPipeline():
+    def __init__(self, level=LOG_LEVEL, levels=LOG_LEVELS,
+                 queue_size=LOG_QUEUE_SIZE, stream=None, fmt=LOG_FORMAT):
+        self.queue = Queue(maxsize=queue_size)
+        self.handler = BoundedQueueHandler(self.queue)
+        self.handler.addFilter(UpdateIdFilter())
+
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(logging.Formatter(fmt))
+        self.listener = QueueListener(self.queue, output)
+
+        self.level = level
+        self.levels = levels
+
+    def start(self):
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+        for name, level in self.levels.items():
+            logging.getLogger(name).setLevel(level)
+
+        self.listener.start()
+
+        return self
+
+    def stop(self):
+        # flushes what is still queued
+        self.listener.stop()
+        logging.getLogger().removeHandler(self.handler)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "dropped": self.handler.dropped,
+            "sampled_out": SampledLogger.sampled_out,
+        }
+
+
+pipeline = LogPipeline()
@@ -0,0 +1,279 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import tornado.web
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, covers both Postgres statements and slow goodreads.com calls
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric():
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        # children are created once and kept, label values must be bounded
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def _child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{labels} {_number(value)}" for name, labels, value in self.samples())
+        return lines
+
+
+class _CounterChild():
+    __slots__ = ("_lock", "value")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield self.name, _labels(self.labelnames, values), child.value
+
+
+class _HistogramChild():
+    __slots__ = ("_lock", "buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                labels = _labels(self.labelnames, values, (("le", _number(bound)),))
+                yield f"{self.name}_bucket", labels, cumulative
+            labels = _labels(self.labelnames, values)
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class StatsCollector():
+    # Exposes the stats() dicts the pools, caches and schedulers already
+    # keep, read at scrape time so they cost nothing in between.
+    # Nested dicts become a "group" label.
+
+    def __init__(self, prefix, label, objects):
+        self.prefix = prefix
+        self.label = label
+        self.objects = objects
+
+    def render(self):
+        families = {}
+        for name, obj in list(self.objects.items()):
+            for key, value, group in self._flatten(obj.stats() if hasattr(obj, "stats") else obj()):
+                extra = (("group", group),) if group else ()
+                families.setdefault(f"{self.prefix}_{key}", []).append(
+                    _labels((self.label,), (name,), extra) + f" {_number(value)}")
+
+        lines = []
+        for family, samples in families.items():
+            lines.append(f"# TYPE {family} untyped")
+            lines.extend(family + sample for sample in samples)
+        return lines
+
+    def _flatten(self, stats, group=None):
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                yield from self._flatten(value, key)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield key, value, group
+
+
+class Registry():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def stats(self, prefix, label, objects):
+        return self.register(StatsCollector(prefix, label, objects))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    "bot_handler_seconds", "Time spent in a Telegram update handler", ("handler",))
+handler_exceptions = registry.counter(
+    "bot_handler_exceptions_total", "Exceptions escaping a handler", ("handler", "exception"))
+api_errors = registry.counter(
+    "goodreads_api_errors_total", "AuthError and ApiError raised by GoodreadsAPI", ("error",))
+upstream_seconds = registry.histogram(
+    "goodreads_request_seconds", "goodreads.com response time, up to the headers",
+    ("method", "endpoint"))
+upstream_responses = registry.counter(
+    "goodreads_responses_total", "goodreads.com responses", ("method", "endpoint", "status"))
+breaker_transitions = registry.counter(
+    "goodreads_breaker_transitions_total", "goodreads.com circuit breaker state changes, by new state",
+    ("state",))
+lane_depth = registry.histogram(
+    "bot_lane_depth", "Updates waiting in the user's lane when one more is queued",
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50))
+sql_seconds = registry.histogram(
+    "postgres_statement_seconds", "Postgres statement execution time", ("statement",))
+
+
+def instrument_handler(callback):
+    name = callback.__name__
+    histogram = handler_seconds.labels(name)
+
+    def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return callback(update, context)
+        except Exception as ex:
+            handler_exceptions.labels(name, type(ex).__name__).inc()
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    # mounted on the webhook server, see add_to_webhook
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.write(registry.render())
+
+
+def add_to_webhook(updater, path="/metrics"):
+    # the webhook app is the only thing listening on PORT on Heroku
+    app = updater.httpd.http_server.request_callback
+    app.add_handlers(r".*", [(path, MetricsHandler)])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, listen="0.0.0.0"):
+    # standalone /metrics listener for when there is no webhook server
+    server = ThreadingHTTPServer((listen, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+    return server
@@ -0,0 +1,194 @@
+from psycopg2.extras import execute_values
+
+import models
+from cache import TTLCache
+from library import EXCLUSIVE_SHELVES
+from models import Book, shelf_name
+from postgres import pool
+
+# users whose initial import is finished, so listings can be served locally
+_ready = TTLCache(maxsize=10000, ttl=60)
+
+
+def is_ready(user_id):
+    ready = _ready.get(user_id)
+    if ready is None:
+        with pool.cursor() as cur:
+            cur.execute("SELECT full_synced_at IS NOT NULL "
+                        "FROM shelf_sync "
+                        "WHERE user_id = %s", (user_id,))
+            row = cur.fetchone()
+        ready = bool(row and row[0])
+        _ready.set(user_id, ready)
+
+    return ready
+
+
+def forget(user_id):
+    _ready.pop(user_id)
+
+
+def get_books(user_id, shelf, page=1, per_page=5):
+    with pool.cursor() as cur:
+        cur.execute("SELECT b.id, b.title, b.publication_year, b.link, b.authors "
+                    "FROM shelf_entries e "
+                    "JOIN books b ON b.id = e.book_id "
+                    "WHERE e.user_id = %s AND e.shelf = %s "
+                    "ORDER BY e.date_added DESC, e.book_id "
+                    "LIMIT %s OFFSET %s", (user_id, shelf, per_page, (page - 1) * per_page))
+        rows = cur.fetchall()
+
+    return [
+        Book(str(book_id), title, models.authors(authors or ()), publication_year, link)
+        for book_id, title, publication_year, link, authors in rows
+    ]
+
+
+def library(user_id):
+    # every shelved book of the user with all the shelves it is on
+    with pool.cursor() as cur:
+        cur.execute("SELECT b.id, b.title, b.authors, b.link, array_agg(e.shelf) "
+                    "FROM shelf_entries e "
+                    "JOIN books b ON b.id = e.book_id "
+                    "WHERE e.user_id = %s "
+                    "GROUP BY b.id", (user_id,))
+        rows = cur.fetchall()
+
+    return [
+        (Book(str(book_id), title, models.authors(authors or ()), link=link),
+         [shelf_name(shelf) for shelf in shelves])
+        for book_id, title, authors, link, shelves in rows
+    ]
+
+
+def sync_state(user_id):
+    # (synced_at, full_synced_at, last_change) or None
+    with pool.cursor() as cur:
+        cur.execute("SELECT synced_at, full_synced_at, last_change "
+                    "FROM shelf_sync "
+                    "WHERE user_id = %s", (user_id,))
+        return cur.fetchone()
+
+
+def due_users(user_ids, interval):
+    # users out of `user_ids` not synced within the last `interval` seconds
+    if not user_ids:
+        return []
+
+    with pool.cursor() as cur:
+        cur.execute("SELECT t.id "
+                    "FROM tokens t "
+                    "LEFT JOIN shelf_sync s ON s.user_id = t.id "
+                    "WHERE t.id = ANY(%s) "
+                    "  AND t.access_token IS NOT NULL "
+                    "  AND (s.synced_at IS NULL "
+                    "       OR s.synced_at < now() - %s * interval '1 second') "
+                    "ORDER BY s.synced_at NULLS FIRST", (list(user_ids), interval))
+        return [row[0] for row in cur.fetchall()]
+
+
+def store_reviews(user_id, reviews, synced_at):
+    # upserts books and replaces the shelf entries of every reviewed book
+    if not reviews:
+        return
+
+    books = {}
+    entries = []
+    for review in reviews:
+        book = review['book']
+        books[int(book.id)] = (int(book.id), book.title, [author.name for author in book.authors],
+                               book.publication_year, book.link)
+        for shelf in review['shelves']:
+            entries.append((user_id, shelf, int(book.id), review['date_added'],
+                            review['date_updated'], synced_at))
+
+    with pool.cursor() as cur:
+        execute_values(cur,
+                       "INSERT INTO books (id, title, authors, publication_year, link) "
+                       "VALUES %s "
+                       "ON CONFLICT (id) DO UPDATE "
+                       "SET (title, authors, publication_year, link) = "
+                       "    (EXCLUDED.title, EXCLUDED.authors, "
+                       "     EXCLUDED.publication_year, EXCLUDED.link)",
+                       list(books.values()))
+        cur.execute("DELETE FROM shelf_entries "
+                    "WHERE user_id = %s AND book_id = ANY(%s)", (user_id, list(books)))
+        execute_values(cur,
+                       "INSERT INTO shelf_entries (user_id, shelf, book_id, date_added, "
+                       "                           date_updated, synced_at) "
+                       "VALUES %s "
+                       "ON CONFLICT DO NOTHING",
+                       entries)
+
+
+def request_sync(user_id):
+    # makes the user due on the next sync poll
+    with pool.cursor() as cur:
+        cur.execute("UPDATE shelf_sync "
+                    "SET synced_at = NULL "
+                    "WHERE user_id = %s", (user_id,))
+
+
+def finish_sync(user_id, synced_at, last_change, full):
+    with pool.cursor() as cur:
+        if full:
+            # whatever the full import didn't see is gone upstream
+            cur.execute("DELETE FROM shelf_entries "
+                        "WHERE user_id = %s AND synced_at < %s", (user_id, synced_at))
+
+        cur.execute("INSERT INTO shelf_sync (user_id, synced_at, full_synced_at, last_change) "
+                    "VALUES (%s, %s, %s, %s) "
+                    "ON CONFLICT (user_id) DO UPDATE "
+                    "SET synced_at = EXCLUDED.synced_at, "
+                    "    full_synced_at = COALESCE(EXCLUDED.full_synced_at, "
+                    "                              shelf_sync.full_synced_at), "
+                    "    last_change = GREATEST(EXCLUDED.last_change, "
+                    "                           shelf_sync.last_change)",
+                    (user_id, synced_at, synced_at if full else None, last_change))
+
+    if full:
+        _ready.pop(user_id)
+
+
+def move_book(user_id, book, book_id, shelf, remove=False):
+    # write-through from add_to_shelf; returns False when the mirror can't
+    # be updated locally (unknown book metadata) and needs a sync instead
+    book_id = int(book_id)
+
+    with pool.cursor() as cur:
+        if remove and shelf in EXCLUSIVE_SHELVES:
+            # off its exclusive shelf the book leaves the library, and every
+            # other shelf with it; incremental syncs don't see deletions
+            cur.execute("DELETE FROM shelf_entries "
+                        "WHERE user_id = %s AND book_id = %s",
+                        (user_id, book_id))
+            return True
+        if remove:
+            cur.execute("DELETE FROM shelf_entries "
+                        "WHERE user_id = %s AND shelf = %s AND book_id = %s",
+                        (user_id, shelf, book_id))
+            return True
+
+        if book is None:
+            cur.execute("SELECT 1 FROM books WHERE id = %s", (book_id,))
+            if cur.fetchone() is None:
+                return False
+        else:
+            cur.execute("INSERT INTO books (id, title, authors, link) "
+                        "VALUES (%s, %s, %s, %s) "
+                        "ON CONFLICT (id) DO NOTHING",
+                        (book_id, book.title, [author.name for author in book.authors], book.link))
+
+        if shelf in EXCLUSIVE_SHELVES:
+            # a book is on at most one of them, adding to one moves it
+            cur.execute("DELETE FROM shelf_entries "
+                        "WHERE user_id = %s AND book_id = %s "
+                        "  AND shelf = ANY(%s) AND shelf != %s",
+                        (user_id, book_id, list(EXCLUSIVE_SHELVES), shelf))
+
+        cur.execute("INSERT INTO shelf_entries (user_id, shelf, book_id, date_added, "
+                    "                           date_updated, synced_at) "
+                    "VALUES (%s, %s, %s, now(), now(), now()) "
+                    "ON CONFLICT DO NOTHING", (user_id, shelf, book_id))
+
+    return True
@@ -0,0 +1,71 @@
+import sys
+from functools import lru_cache
+from typing import NamedTuple, Optional, Tuple
+
+
+class Author(NamedTuple):
+    name: str
+
+    def __str__(self):
+        return self.name
+
+
+class Book(NamedTuple):
+    # Fields an endpoint doesn't return stay None. Books are shared by
+    # every cache and reader holding them, make changed copies with
+    # _replace() instead of changing them.
+
+    id: str
+    title: str
+    authors: Tuple[Author, ...] = ()
+    publication_year: Optional[str] = None
+    link: Optional[str] = None
+    image_url: Optional[str] = None
+    description: Optional[str] = None
+    # the user's shelves it is on, for books out of their library
+    shelves: Tuple[str, ...] = ()
+
+    @property
+    def author_names(self):
+        return ", ".join(author.name for author in self.authors)
+
+    @classmethod
+    def load(cls, values):
+        # from the JSON array a Book is stored as
+        book = cls._make(values)
+        return book._replace(authors=authors(name for name, in book.authors),
+                             shelves=tuple(map(shelf_name, book.shelves)))
+
+
+class Shelf(NamedTuple):
+    name: str
+    book_count: int
+    show_name: str
+
+    @classmethod
+    def load(cls, values):
+        name, book_count, show_name = values
+        return cls(shelf_name(name), book_count, show_name)
+
+
+@lru_cache(maxsize=100000)
+def author(name):
+    # one shared Author per name, the same few come up in most results
+    return Author(sys.intern(name or ""))
+
+
+def authors(names):
+    return tuple(author(name) for name in names)
+
+
+def shelf_name(name):
+    # a handful of names repeated for every book and user
+    return sys.intern(name) if name else name
+
+
+def load_books(values):
+    return [Book.load(book) for book in values]
+
+
+def load_shelves(values):
+    return [Shelf.load(shelf) for shelf in values]
@@ -0,0 +1,168 @@
+from datetime import datetime
+from xml.etree import ElementTree
+
+from config import XML_PARSER
+from models import Book, Shelf, authors, shelf_name
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+
+def parse_date(value):
+    # "Sat Oct 03 04:17:52 -0700 2020"
+    return datetime.strptime(value, "%a %b %d %H:%M:%S %z %Y") if value else None
+
+
+def response_source(response):
+    # file-like body of a `stream=True` response, gzip already decoded
+    response.raw.decode_content = True
+    return response.raw
+
+
+class Parser():
+    # Pulls the fields the bot needs out of Goodreads XML. List endpoints
+    # are read incrementally, subtrees that were already handled are
+    # dropped as parsing goes on.
+
+    name = None
+
+    def fromstring(self, content):
+        raise NotImplementedError
+
+    def iterparse(self, source, tag):
+        raise NotImplementedError
+
+    def fields(self, entry, names):
+        # one pass over the children instead of a find() per field,
+        # which is noticeably slower with lxml
+        values = dict.fromkeys(names)
+        for child in entry:
+            if child.tag in values and values[child.tag] is None:
+                values[child.tag] = child.text
+
+        return values
+
+    def authors(self, entry):
+        return authors(self.fields(author, ('name',))['name'] for author in entry.iter('author'))
+
+    def auth_user(self, content):
+        return self.fromstring(content).find('user').attrib['id']
+
+    def search_books(self, source):
+        books = []
+        for entry in self.iterparse(source, 'best_book'):
+            fields = self.fields(entry, ('id', 'title', 'image_url'))
+            books.append(Book(fields['id'], fields['title'], self.authors(entry),
+                              image_url=fields['image_url']))
+
+        return books
+
+    def shelves(self, source):
+        shelves = []
+        for entry in self.iterparse(source, 'user_shelf'):
+            fields = self.fields(entry, ('name', 'book_count'))
+            name = shelf_name(fields['name'])
+            shelves.append(Shelf(name, int(fields['book_count'] or 0),
+                                 " ".join(name.split("-")).title()))
+
+        return shelves
+
+    def _book(self, entry):
+        fields = self.fields(entry, ('id', 'title', 'publication_year', 'link'))
+        return Book(fields['id'], fields['title'], self.authors(entry),
+                    fields['publication_year'], fields['link'])
+
+    def books(self, source):
+        return [self._book(entry) for entry in self.iterparse(source, 'book')]
+
+    def reviews(self, source):
+        # /review/list entries with the book and the shelves it is on
+        reviews = []
+        for entry in self.iterparse(source, 'review'):
+            fields = self.fields(entry, ('date_added', 'date_updated'))
+
+            reviews.append({
+                'book': self._book(entry.find('book')),
+                'shelves': [shelf_name(shelf.attrib['name']) for shelf in entry.iter('shelf')],
+                'date_added': parse_date(fields['date_added']),
+                'date_updated': parse_date(fields['date_updated']),
+            })
+
+        return reviews
+
+    def book(self, content):
+        book_xml = self.fromstring(content).find('book')
+
+        fields = self.fields(book_xml, ('id', 'title', 'description', 'link',
+                                        'image_url', 'small_image_url'))
+        book = Book(fields['id'], fields['title'], self.authors(book_xml.find('authors')),
+                    link=fields['link'],
+                    image_url=fields['image_url'] or fields['small_image_url'],
+                    description=fields['description'])
+        shelf_xml = book_xml.find('./my_review/shelves/shelf')
+        shelf = shelf_name(shelf_xml.attrib['name']) if shelf_xml is not None else None
+
+        return book, shelf
+
+    def review_shelf(self, content):
+        shelf_xml = self.fromstring(content).find('./review/shelves/shelf')
+
+        return shelf_name(shelf_xml.attrib['name']) if shelf_xml is not None else None
+
+
+class ElementTreeParser(Parser):
+    name = 'etree'
+
+    def fromstring(self, content):
+        return ElementTree.fromstring(content)
+
+    def iterparse(self, source, tag):
+        # stdlib elements don't know their parent, keep the open path
+        path = []
+        for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                path.append(elem)
+                continue
+
+            path.pop()
+            if elem.tag != tag:
+                continue
+
+            yield elem
+
+            # everything under the parent is finished, above it only the
+            # last child is still open
+            if path:
+                del path[-1][:]
+            for ancestor in path[:-1]:
+                del ancestor[:-1]
+
+
+class LxmlParser(Parser):
+    name = 'lxml'
+
+    def fromstring(self, content):
+        return etree.fromstring(content)
+
+    def iterparse(self, source, tag):
+        for _, elem in etree.iterparse(source, events=('end',), tag=tag,
+                                       resolve_entities=False):
+            yield elem
+
+            elem.clear(keep_tail=True)
+            for node in [elem, *elem.iterancestors()]:
+                while node.getprevious() is not None:
+                    del node.getparent()[0]
+
+
+parsers = {
+    ElementTreeParser.name: ElementTreeParser,
+    LxmlParser.name: LxmlParser,
+}
+
+if XML_PARSER == LxmlParser.name and etree is None:
+    parser = ElementTreeParser()
+else:
+    parser = parsers[XML_PARSER]()
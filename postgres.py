@@ -1,22 +1,244 @@
 import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
 
 import psycopg2
+import psycopg2.extensions
 
-from config import DATABASE_URL
+from config import (DATABASE_URL, DB_HEALTHCHECK_INTERVAL, DB_POOL_MAX,
+                    DB_POOL_MIN, DB_POOL_TIMEOUT)
+from metrics import sql_seconds
 
+TABLE_RE = re.compile(r"\b(?:from|into|update|table|index)\s+(?:if\s+not\s+exists\s+)?(\w+)",
+                      re.IGNORECASE)
+
+
+@lru_cache(maxsize=256)
+def statement_name(head):
+    # metric label for a statement, "select tokens", "insert shelf_entries"
+    verb = head.split(None, 1)[0].lower() if head.strip() else ""
+    match = TABLE_RE.search(head)
+
+    return f"{verb} {match.group(1).lower()}" if match else verb
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        head = query[:200].decode(errors="replace") if isinstance(query, bytes) else query[:200]
+        with sql_seconds.labels(statement_name(head)).time():
+            return super().execute(query, vars)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool():
+    # psycopg2.pool closes every connection above minconn on putconn,
+    # so under load it reconnects all the time; this one keeps up to
+    # maxconn idle connections and blocks callers while all are busy.
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=10,
+                 healthcheck_interval=30, **connect_kwargs):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.connect_kwargs = connect_kwargs
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._idle = []
+        self._last_used = {}
+        self._counters = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "max_wait_time": 0.0,
+            "timeouts": 0,
+            "connects": 0,
+            "reconnects": 0,
+            "in_use": 0,
+            "max_in_use": 0,
+        }
+
+        for _ in range(minconn):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, **self.connect_kwargs)
+        with self._lock:
+            self._counters["connects"] += 1
+            self._last_used[id(conn)] = time.monotonic()
+        return conn
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+
+        idle_for = time.monotonic() - self._last_used.get(id(conn), 0)
+        if idle_for < self.healthcheck_interval:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def _discard(self, conn):
+        with self._lock:
+            self._last_used.pop(id(conn), None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _checkout(self):
+        started = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._counters["waits"] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self._counters["timeouts"] += 1
+                raise PoolTimeout(f"No free database connection in {self.timeout}s")
+
+        waited = time.monotonic() - started
+        with self._lock:
+            self._counters["checkouts"] += 1
+            self._counters["wait_time"] += waited
+            self._counters["max_wait_time"] = max(self._counters["max_wait_time"], waited)
+            self._counters["in_use"] += 1
+            self._counters["max_in_use"] = max(self._counters["max_in_use"],
+                                               self._counters["in_use"])
+            conn = self._idle.pop() if self._idle else None
+
+        try:
+            if conn is not None and not self._is_healthy(conn):
+                self._discard(conn)
+                conn = None
+                with self._lock:
+                    self._counters["reconnects"] += 1
+
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            self._release(None)
+            raise
+
+        return conn
+
+    def _release(self, conn, broken=False):
+        with self._lock:
+            self._counters["in_use"] -= 1
+            if conn is not None and not broken and not conn.closed:
+                self._last_used[id(conn)] = time.monotonic()
+                self._idle.append(conn)
+                conn = None
+
+        if conn is not None:
+            self._discard(conn)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self._checkout()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn, broken=broken)
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                yield cur
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["idle"] = len(self._idle)
+
+        stats["size"] = stats["idle"] + stats["in_use"]
+        stats["utilization"] = stats["in_use"] / self.maxconn
+        stats["avg_wait_time"] = stats["wait_time"] / (stats["checkouts"] or 1)
+
+        return stats
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+
+connect_kwargs = {'cursor_factory': TimedCursor}
 if os.environ.get("HEROKU"):
-    conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-else:
-    conn = psycopg2.connect(DATABASE_URL)
-
-cur = conn.cursor()
-# cur.execute("DROP TABLE tokens;")
-cur.execute("CREATE TABLE IF NOT EXISTS tokens ("
-            "   id INTEGER PRIMARY KEY,"
-            "   request_token VARCHAR,"
-            "   request_token_secret VARCHAR,"
-            "   access_token VARCHAR,"
-            "   access_token_secret VARCHAR,"
-            "   goodreads_id INTEGER)")
-cur.close()
-conn.commit()
+    connect_kwargs['sslmode'] = 'require'
+
+pool = ConnectionPool(DATABASE_URL,
+                      minconn=DB_POOL_MIN,
+                      maxconn=DB_POOL_MAX,
+                      timeout=DB_POOL_TIMEOUT,
+                      healthcheck_interval=DB_HEALTHCHECK_INTERVAL,
+                      **connect_kwargs)
+
+with pool.cursor() as cur:
+    # cur.execute("DROP TABLE tokens;")
+    cur.execute("CREATE TABLE IF NOT EXISTS tokens ("
+                "   id INTEGER PRIMARY KEY,"
+                "   request_token VARCHAR,"
+                "   request_token_secret VARCHAR,"
+                "   access_token VARCHAR,"
+                "   access_token_secret VARCHAR,"
+                "   goodreads_id INTEGER)")
+
+    # local mirror of the users' shelves, filled by sync.ShelfSync
+    cur.execute("CREATE TABLE IF NOT EXISTS books ("
+                "   id INTEGER PRIMARY KEY,"
+                "   title VARCHAR,"
+                "   authors VARCHAR[],"
+                "   publication_year VARCHAR,"
+                "   link VARCHAR)")
+    cur.execute("CREATE TABLE IF NOT EXISTS shelf_entries ("
+                "   user_id INTEGER REFERENCES tokens (id) ON DELETE CASCADE,"
+                "   shelf VARCHAR,"
+                "   book_id INTEGER REFERENCES books (id),"
+                "   date_added TIMESTAMPTZ,"
+                "   date_updated TIMESTAMPTZ,"
+                "   synced_at TIMESTAMPTZ,"
+                "   PRIMARY KEY (user_id, shelf, book_id))")
+    cur.execute("CREATE INDEX IF NOT EXISTS shelf_entries_listing_idx "
+                "ON shelf_entries (user_id, shelf, date_added DESC, book_id)")
+    cur.execute("CREATE TABLE IF NOT EXISTS shelf_sync ("
+                "   user_id INTEGER PRIMARY KEY REFERENCES tokens (id) ON DELETE CASCADE,"
+                "   synced_at TIMESTAMPTZ,"
+                "   full_synced_at TIMESTAMPTZ,"
+                "   last_change TIMESTAMPTZ)")
+
+    # second cache tier, see tiered.py
+    cur.execute("CREATE TABLE IF NOT EXISTS cache_entries ("
+                "   namespace VARCHAR,"
+                "   key VARCHAR,"
+                "   value JSONB,"
+                "   expires_at TIMESTAMPTZ,"
+                "   updated_at TIMESTAMPTZ DEFAULT now(),"
+                "   PRIMARY KEY (namespace, key))")
+    cur.execute("CREATE INDEX IF NOT EXISTS cache_entries_updated_idx "
+                "ON cache_entries (updated_at DESC)")
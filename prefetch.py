@@ -0,0 +1,175 @@
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from breaker import CircuitOpen, breaker
+from cache import TTLCache
+from config import (PREFETCH_QUEUE, PREFETCH_USER_BUDGET, PREFETCH_WORKERS,
+                    REVALIDATE_QUEUE, REVALIDATE_WORKERS)
+from ratelimit import PREFETCH, current_priority, priority
+
+_local = threading.local()
+
+
+class Prefetcher():
+    # Fetches the page a user is likely to open next in the background, at
+    # PREFETCH priority, so the result is already cached when they tap ➡️.
+    # Only the latest prefetch per user is kept: scheduling a new one or
+    # navigating elsewhere cancels a queued one.
+
+    def __init__(self, workers, user_budget, max_queue):
+        self.user_budget = user_budget
+        self.max_queue = max_queue
+
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='prefetch')
+        self._lock = threading.Lock()
+        self._queued = {}
+        self._running = defaultdict(int)
+        self._fetched = TTLCache(maxsize=10000, ttl=600)
+        self._counters = {
+            "scheduled": 0,
+            "cancelled": 0,
+            "skipped": 0,
+            "completed": 0,
+            # found everything already cached, can't be used
+            "cached": 0,
+            "failed": 0,
+            "used": 0,
+        }
+
+    def schedule(self, user_id, func, *args, **kwargs):
+        with self._lock:
+            self._cancel(user_id)
+
+            if self._running.get(user_id, 0) >= self.user_budget or \
+                    len(self._queued) >= self.max_queue:
+                self._counters["skipped"] += 1
+                return
+
+            # _run needs its own future, it can't start before we release the lock
+            handle = []
+            future = self._executor.submit(self._run, user_id, handle, func, args, kwargs)
+            handle.append(future)
+            self._queued[user_id] = future
+            self._counters["scheduled"] += 1
+
+    def cancel(self, user_id):
+        with self._lock:
+            self._cancel(user_id)
+
+    def _cancel(self, user_id):
+        future = self._queued.pop(user_id, None)
+        if future is not None and future.cancel():
+            self._counters["cancelled"] += 1
+
+    def _run(self, user_id, handle, func, args, kwargs):
+        with self._lock:
+            if self._queued.get(user_id) is handle[0]:
+                del self._queued[user_id]
+            self._running[user_id] += 1
+
+        _local.filled = False
+        try:
+            with priority(PREFETCH):
+                func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self._counters["failed"] += 1
+        else:
+            with self._lock:
+                self._counters["completed" if _local.filled else "cached"] += 1
+        finally:
+            with self._lock:
+                self._running[user_id] -= 1
+                if not self._running[user_id]:
+                    del self._running[user_id]
+
+    def filled(self, key):
+        # called by the cache layer when it stores `key`
+        if current_priority() == PREFETCH:
+            self._fetched.set(key, True)
+            _local.filled = True
+
+    def hit(self, key):
+        # called by the cache layer when `key` is served from cache
+        if current_priority() != PREFETCH and self._fetched.pop(key) is not None:
+            with self._lock:
+                self._counters["used"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["queued"] = len(self._queued)
+            stats["running"] = sum(self._running.values())
+
+        stats["hit_rate"] = stats["used"] / stats["completed"] if stats["completed"] else 0.0
+
+        return stats
+
+
+class Revalidator():
+    # Refreshes cache entries that were served stale, once per key, as soon
+    # as the circuit breaker lets a request through again.
+
+    attempts = 5
+
+    def __init__(self, workers, max_queue):
+        self.max_queue = max_queue
+
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='revalidate')
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._counters = {
+            "scheduled": 0,
+            "skipped": 0,
+            "completed": 0,
+            "failed": 0,
+        }
+
+    def schedule(self, key, func, *args, **kwargs):
+        with self._lock:
+            if key in self._pending or len(self._pending) >= self.max_queue:
+                self._counters["skipped"] += 1
+                return
+
+            self._pending.add(key)
+            self._counters["scheduled"] += 1
+
+        self._executor.submit(self._run, key, func, args, kwargs)
+
+    def _run(self, key, func, args, kwargs):
+        try:
+            for attempt in range(self.attempts):
+                breaker.wait()
+                try:
+                    with priority(PREFETCH):
+                        func(*args, **kwargs)
+                    break
+                except CircuitOpen:
+                    # another request is the half-open probe, wait for its outcome
+                    if attempt == self.attempts - 1:
+                        raise
+                    time.sleep(1)
+        except Exception:
+            with self._lock:
+                self._counters["failed"] += 1
+        else:
+            with self._lock:
+                self._counters["completed"] += 1
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["pending"] = len(self._pending)
+
+        return stats
+
+
+prefetcher = Prefetcher(PREFETCH_WORKERS, PREFETCH_USER_BUDGET, PREFETCH_QUEUE)
+revalidator = Revalidator(REVALIDATE_WORKERS, REVALIDATE_QUEUE)
@@ -0,0 +1,152 @@
+import heapq
+import threading
+import time
+from contextlib import contextmanager
+from itertools import count
+
+from cache import TTLCache
+from config import (UPSTREAM_BURST, UPSTREAM_RATE, UPSTREAM_USER_BURST,
+                    UPSTREAM_USER_RATE)
+
+# lower goes first
+INTERACTIVE = 0
+SEARCH = 1
+PREFETCH = 2
+
+PRIORITY_NAMES = {
+    INTERACTIVE: "interactive",
+    SEARCH: "search",
+    PREFETCH: "prefetch",
+}
+
+_local = threading.local()
+
+
+@contextmanager
+def priority(level):
+    # priority of the upstream requests made by this thread
+    previous = current_priority()
+    _local.priority = level
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority():
+    return getattr(_local, 'priority', INTERACTIVE)
+
+
+class TokenBucket():
+    # not thread-safe, callers hold their own lock
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        # seconds until a token is available
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class Scheduler():
+    # Central token bucket for all goodreads.com requests. Waiting requests
+    # are released in priority order, FIFO within one priority. Each user
+    # also has a smaller bucket of their own, checked before the global one
+    # and released in the same order, so a user's own prefetches don't
+    # hold up what they are waiting for.
+
+    def __init__(self, rate, burst, user_rate, user_burst):
+        self.rate = rate
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+
+        self._bucket = TokenBucket(rate, burst) if rate else None
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._sequence = count()
+
+        self._users_lock = threading.Lock()
+        self._user_buckets = TTLCache(maxsize=10000, ttl=600)
+
+        self._counters = {
+            name: {"requests": 0, "queued": 0, "wait_time": 0.0, "max_wait_time": 0.0}
+            for name in PRIORITY_NAMES.values()
+        }
+
+    def _take_in_turn(self, cond, waiting, bucket, entry):
+        # called holding `cond`, returns once `entry` is first in `waiting`
+        # and has taken a token from `bucket`
+        heapq.heappush(waiting, entry)
+        while True:
+            if waiting[0] == entry:
+                delay = bucket.delay()
+                if not delay:
+                    bucket.take()
+                    heapq.heappop(waiting)
+                    break
+                cond.wait(delay)
+            else:
+                cond.wait()
+
+        cond.notify_all()
+
+    def _wait_for_user(self, level, user_id):
+        with self._users_lock:
+            user = self._user_buckets.get(user_id)
+            if user is None:
+                # (bucket, waiting heap, condition) of the user
+                user = (TokenBucket(self.user_rate, self.user_burst), [], threading.Condition())
+                self._user_buckets.set(user_id, user)
+
+        bucket, waiting, cond = user
+        with cond:
+            self._take_in_turn(cond, waiting, bucket, (level, next(self._sequence)))
+
+    def _wait_for_global(self, level):
+        entry = (level, next(self._sequence))
+
+        with self._cond:
+            self._counters[PRIORITY_NAMES[level]]["queued"] += 1
+            self._take_in_turn(self._cond, self._waiting, self._bucket, entry)
+            self._counters[PRIORITY_NAMES[level]]["queued"] -= 1
+
+    def acquire(self, level=None, user_id=None):
+        level = current_priority() if level is None else level
+        started = time.monotonic()
+
+        if self.user_rate and user_id is not None:
+            self._wait_for_user(level, user_id)
+        if self._bucket is not None:
+            self._wait_for_global(level)
+
+        waited = time.monotonic() - started
+        with self._cond:
+            counters = self._counters[PRIORITY_NAMES[level]]
+            counters["requests"] += 1
+            counters["wait_time"] += waited
+            counters["max_wait_time"] = max(counters["max_wait_time"], waited)
+
+        return waited
+
+    def stats(self):
+        with self._cond:
+            stats = {name: dict(counters) for name, counters in self._counters.items()}
+            stats["queue_depth"] = len(self._waiting)
+
+        return stats
+
+
+scheduler = Scheduler(UPSTREAM_RATE, UPSTREAM_BURST,
+                      UPSTREAM_USER_RATE, UPSTREAM_USER_BURST)
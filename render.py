@@ -0,0 +1,105 @@
+from functools import lru_cache
+
+from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,
+                      InputTextMessageContent, ParseMode)
+
+from config import RENDER_CACHE_SIZE
+from utils import strip_tags
+
+# Books are immutable and compare by value, so a Book is its own metadata
+# version: a changed title or description is a different key. The rendered
+# strings and markups are shared by every update showing them and must not
+# be changed.
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def search_card(book):
+    return (
+        f"*{strip_tags(book.title)}*{' 📚' if book.shelves else ''} \n"
+        f"{book.author_names}\n"
+        f"/book\_{book.id} "  # noqa
+    )
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def shelf_card(book):
+    return (
+        f"*{strip_tags(book.title)}* "
+        f"[→]({book.link})\n"
+        f"{book.author_names}\n"
+        f"/book\_{book.id} "  # noqa
+    )
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def book_card(book):
+    book_md = (
+        f"*{book.title}* \n"
+        f"{book.author_names}\n\n"
+    )
+    if book.description:
+        book_md = book_md + f"{book.description[:200]}... "
+
+    book_md = book_md + f"[На сайте 🌎]({book.link})\n"
+
+    return strip_tags(book_md)
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def inline_card(book):
+    # everything of an InlineQueryResultArticle but its per-answer id
+    book_md = (
+        f"*{strip_tags(book.title)}* \n"
+        f"{book.author_names}\n"
+        f"[На сайте 🌎](https://www.goodreads.com/book/show/{book.id})"
+    )
+    add_book_button = InlineKeyboardButton("Добавить книгу 📚", callback_data=f"inlinebook {book.id}")
+
+    return {
+        "title": strip_tags(book.title) + (" 📚" if book.shelves else ""),
+        "thumb_url": book.image_url,
+        "description": book.author_names,
+        "input_message_content": InputTextMessageContent(book_md, ParseMode.MARKDOWN),
+        "reply_markup": InlineKeyboardMarkup([[add_book_button]]),
+    }
+
+
+def shelf_set(shelves):
+    # what the keyboard depends on, book counts changing don't rebuild it
+    return tuple((shelf.show_name, shelf.name) for shelf in shelves)
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def book_keyboard(shelves, shelf, book_id):
+    # `shelves` from shelf_set(), `shelf` the one the book is on
+    buttons = []
+    for text, value in shelves:
+        button_text = text if shelf != value else f"{text} 📚"
+        buttons.append([InlineKeyboardButton(button_text, callback_data=f'add_to_shelf {value} {book_id}')])
+    if shelf:
+        buttons.append([InlineKeyboardButton('Remove 🗑', callback_data=f'rm_from_shelf {shelf} {book_id}')])
+
+    return InlineKeyboardMarkup(buttons)
+
+
+RENDERERS = {
+    "search_card": search_card,
+    "shelf_card": shelf_card,
+    "book_card": book_card,
+    "inline_card": inline_card,
+    "book_keyboard": book_keyboard,
+}
+
+
+def stats():
+    stats = {}
+    for name, renderer in RENDERERS.items():
+        info = renderer.cache_info()
+        stats[name] = {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+
+    return stats
+
+
+def clear():
+    for renderer in RENDERERS.values():
+        renderer.cache_clear()
@@ -1,27 +1,47 @@
 from rauth.service import OAuth1Service
 
-from config import CONSUMER_KEY, CONSUMER_SECRET
-from postgres import conn
+from cache import TTLCache
+from config import (CONSUMER_KEY, CONSUMER_SECRET, GOODREADS_URL,
+                    SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+from postgres import pool
+from transport import GoodreadsSession
+
+sessions_cache = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
 
 
 class MyOAuth1Service(OAuth1Service):
     def get_db_tokens_session(self, user_id):
-        with conn.cursor() as cur:
-            cur.execute("SELECT access_token, access_token_secret "
+        session = sessions_cache.get(user_id)
+        if session is not None:
+            return session
+
+        with pool.cursor() as cur:
+            cur.execute("SELECT access_token, access_token_secret, "
+                        "       goodreads_id "
                         "FROM tokens "
                         "where id = %s", (user_id,))
-            tokens = cur.fetchone()
+            row = cur.fetchone()
 
+        tokens = row[:2] if row else None
         if tokens and all(tokens):
-            return super().get_session(token=tokens)
+            session = super().get_session(token=tokens)
+            session.user_id = user_id
+            session.goodreads_id = row[2]
+            sessions_cache.set(user_id, session)
+
+            return session
+
+    def invalidate_session(self, user_id):
+        sessions_cache.pop(user_id)
 
 
 goodreads_service = MyOAuth1Service(
     consumer_key=CONSUMER_KEY,
     consumer_secret=CONSUMER_SECRET,
     name='goodreads',
-    request_token_url='https://www.goodreads.com/oauth/request_token',
-    authorize_url='https://www.goodreads.com/oauth/authorize',
-    access_token_url='https://www.goodreads.com/oauth/access_token',
-    base_url='https://www.goodreads.com/'
+    request_token_url=f'{GOODREADS_URL}oauth/request_token',
+    authorize_url=f'{GOODREADS_URL}oauth/authorize',
+    access_token_url=f'{GOODREADS_URL}oauth/access_token',
+    base_url=GOODREADS_URL,
+    session_obj=GoodreadsSession,
 )
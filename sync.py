@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import mirror
+from api import goodreads_api, libraries
+from cache import TTLCache
+from config import (SYNC_FULL_INTERVAL, SYNC_INTERVAL, SYNC_MAX_BACKOFF,
+                    SYNC_PER_PAGE, SYNC_POLL)
+from ratelimit import PREFETCH, priority
+
+logger = logging.getLogger(__name__)
+
+
+class ShelfSync():
+    # Keeps the Postgres mirror of recently active users' shelves fresh.
+    # The first sync and then one a day import the whole library, the
+    # others only read /review/list newest change first until they reach
+    # the last change they have already seen. A user whose syncs keep
+    # failing (e.g. a revoked token) is retried less and less often.
+
+    def __init__(self, interval, full_interval, poll, per_page, max_backoff):
+        self.interval = interval
+        self.full_interval = timedelta(seconds=full_interval)
+        self.poll = poll
+        self.per_page = per_page
+        self.max_backoff = max_backoff
+
+        self._active = TTLCache(maxsize=10000, ttl=24 * 3600)
+        # user_id -> (failures in a row, monotonic time of the next try)
+        self._failing = TTLCache(maxsize=10000, ttl=24 * 3600)
+        self._lock = threading.Lock()
+        self._requested = []
+        self._wakeup = threading.Event()
+        self._counters = {
+            "syncs": 0,
+            "full_syncs": 0,
+            "failed": 0,
+            "pages": 0,
+            "reviews": 0,
+        }
+
+    def touch(self, user_id):
+        # only users seen recently are kept in sync
+        self._active.set(user_id, True)
+
+    def request(self, user_id):
+        # sync as soon as possible, e.g. right after authorization
+        self.touch(user_id)
+        with self._lock:
+            if user_id not in self._requested:
+                self._requested.append(user_id)
+        self._wakeup.set()
+
+    def start(self):
+        thread = threading.Thread(target=self._loop, name='shelf-sync', daemon=True)
+        thread.start()
+
+        return thread
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait(self.poll)
+            self._wakeup.clear()
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("shelf sync failed")
+
+    def run_once(self):
+        with self._lock:
+            user_ids, self._requested = self._requested, []
+
+        # requested ones are tried right away, the user may have fixed it
+        now = time.monotonic()
+        for user_id in mirror.due_users(self._active.keys(), self.interval):
+            failing = self._failing.get(user_id)
+            if failing is not None and failing[1] > now:
+                continue
+            if user_id not in user_ids:
+                user_ids.append(user_id)
+
+        for user_id in user_ids:
+            try:
+                self.sync_user(user_id)
+            except Exception as ex:
+                self._failed(user_id, ex)
+            else:
+                self._failing.pop(user_id)
+
+    def _failed(self, user_id, ex):
+        failures = self._failing.get(user_id, (0, None))[0] + 1
+        backoff = min(self.poll * 2 ** (failures - 1), self.max_backoff)
+        self._failing.set(user_id, (failures, time.monotonic() + backoff))
+
+        # the traceback once, then a line per failure
+        if failures == 1:
+            logger.exception("shelf sync failed, user_id: %s", user_id)
+        else:
+            logger.warning("shelf sync failed %s times in a row, user_id: %s, retry in %.0fs: %r",
+                           failures, user_id, backoff, ex)
+        with self._lock:
+            self._counters["failed"] += 1
+
+    def sync_user(self, user_id):
+        started = datetime.now(timezone.utc)
+        state = mirror.sync_state(user_id)
+        full = state is None or state[1] is None or started - state[1] > self.full_interval
+        last_change = None if full else state[2]
+
+        newest = last_change
+        changes = 0
+        page = 1
+        with priority(PREFETCH):
+            while True:
+                reviews = goodreads_api.get_reviews(user_id, page, self.per_page)
+                changed = [review for review in reviews
+                           if last_change is None or review['date_updated'] is None
+                           or review['date_updated'] > last_change]
+                mirror.store_reviews(user_id, changed, started)
+                changes += len(changed)
+
+                with self._lock:
+                    self._counters["pages"] += 1
+                    self._counters["reviews"] += len(changed)
+
+                for review in changed:
+                    if review['date_updated'] and (newest is None or review['date_updated'] > newest):
+                        newest = review['date_updated']
+
+                # sorted by date_updated, the rest of the pages is unchanged
+                if len(reviews) < self.per_page or len(changed) < len(reviews):
+                    break
+                page += 1
+
+        mirror.finish_sync(user_id, started, newest, full)
+        if changes:
+            # rebuilt from the mirror on the next search
+            libraries.pop(user_id)
+
+        with self._lock:
+            self._counters["syncs"] += 1
+            if full:
+                self._counters["full_syncs"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["requested"] = len(self._requested)
+        stats["active"] = len(self._active)
+        stats["failing"] = len(self._failing)
+
+        return stats
+
+
+shelf_sync = ShelfSync(SYNC_INTERVAL, SYNC_FULL_INTERVAL, SYNC_POLL, SYNC_PER_PAGE,
+                       SYNC_MAX_BACKOFF)
@@ -0,0 +1,296 @@
+import json
+import logging
+import threading
+import time
+from queue import Empty, Full, Queue
+
+import psycopg2
+from psycopg2.extras import Json, execute_values
+
+from cache import TTLCache
+from config import (CACHE_STALE_TTL, L2_CACHE, L2_CLEANUP_INTERVAL,
+                    L2_MISS_TTL, L2_QUEUE, L2_WARM_ENTRIES, L2_WARM_SECONDS)
+from postgres import PoolTimeout, pool
+
+logger = logging.getLogger(__name__)
+
+
+def _dump_key(key):
+    return json.dumps(key)
+
+
+def _load_key(text):
+    key = json.loads(text)
+    return tuple(key) if isinstance(key, list) else key
+
+
+class L2Store():
+    # cache_entries in Postgres. Reads are synchronous, writes and deletes
+    # are queued to a background thread that applies them in order, in
+    # batches, so a cache fill costs the request nothing. Writes are
+    # dropped rather than block when the queue is full.
+
+    def __init__(self, queue_size=L2_QUEUE, batch=200, stale_ttl=CACHE_STALE_TTL,
+                 cleanup_interval=L2_CLEANUP_INTERVAL):
+        self.batch = batch
+        self.stale_ttl = stale_ttl
+        self.cleanup_interval = cleanup_interval
+
+        self._queue = Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._counters = {
+            "reads": 0,
+            "writes": 0,
+            "deletes": 0,
+            "dropped": 0,
+            "errors": 0,
+            "read_errors": 0,
+            "warmed": 0,
+        }
+
+    def get(self, namespace, key, stale=False):
+        # (value, seconds until it expires) or None, expired entries too
+        # with `stale` as long as they are within stale_ttl. A failed read
+        # is a miss, the request can still go to goodreads.com.
+        try:
+            with pool.cursor() as cur:
+                cur.execute("SELECT value, EXTRACT(EPOCH FROM expires_at - now()) "
+                            "FROM cache_entries "
+                            "WHERE namespace = %s AND key = %s AND expires_at > now() - %s * interval '1 second'",
+                            (namespace, key, self.stale_ttl if stale else 0))
+                row = cur.fetchone()
+        except (psycopg2.Error, PoolTimeout) as ex:
+            logger.warning("l2 cache read failed: %s", ex)
+            with self._lock:
+                self._counters["read_errors"] += 1
+            return None
+
+        with self._lock:
+            self._counters["reads"] += 1
+
+        return (row[0], float(row[1])) if row else None
+
+    def set(self, namespace, key, value, ttl):
+        self._put(("set", namespace, key, value, ttl))
+
+    def delete(self, namespace, key):
+        self._put(("delete", namespace, key))
+
+    def _put(self, op):
+        self._start()
+        try:
+            self._queue.put_nowait(op)
+        except Full:
+            with self._lock:
+                self._counters["dropped"] += 1
+
+    def _start(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='l2-writer', daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        cleaned_at = time.monotonic()
+        while True:
+            try:
+                ops = [self._queue.get(timeout=self.cleanup_interval)]
+            except Empty:
+                ops = []
+            while len(ops) < self.batch:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except Empty:
+                    break
+
+            if None in ops:
+                # stop()
+                ops = ops[:ops.index(None)]
+                self._apply(ops)
+                return
+
+            try:
+                self._apply(ops)
+                if time.monotonic() - cleaned_at >= self.cleanup_interval:
+                    self._cleanup()
+                    cleaned_at = time.monotonic()
+            except Exception:
+                logger.exception("l2 cache write failed")
+                with self._lock:
+                    self._counters["errors"] += 1
+
+    def _apply(self, ops):
+        if not ops:
+            return
+
+        with pool.cursor() as cur:
+            # consecutive sets go in one statement, order is kept otherwise
+            rows = {}
+            for op in ops:
+                if op[0] == "set":
+                    _, namespace, key, value, ttl = op
+                    rows[namespace, key] = (namespace, key, Json(value), ttl)
+                    continue
+
+                self._write(cur, rows)
+                rows = {}
+                _, namespace, key = op
+                cur.execute("DELETE FROM cache_entries "
+                            "WHERE namespace = %s AND key = %s", (namespace, key))
+                with self._lock:
+                    self._counters["deletes"] += 1
+            self._write(cur, rows)
+
+    def _write(self, cur, rows):
+        if not rows:
+            return
+
+        execute_values(cur,
+                       "INSERT INTO cache_entries (namespace, key, value, expires_at) "
+                       "VALUES %s "
+                       "ON CONFLICT (namespace, key) DO UPDATE "
+                       "SET value = EXCLUDED.value, "
+                       "    expires_at = EXCLUDED.expires_at, "
+                       "    updated_at = now()",
+                       list(rows.values()),
+                       template="(%s, %s, %s, now() + %s * interval '1 second')")
+        with self._lock:
+            self._counters["writes"] += len(rows)
+
+    def _cleanup(self):
+        with pool.cursor() as cur:
+            cur.execute("DELETE FROM cache_entries "
+                        "WHERE expires_at < now() - %s * interval '1 second'", (self.stale_ttl,))
+
+    def warm_up(self, caches, max_entries=L2_WARM_ENTRIES, budget=L2_WARM_SECONDS):
+        # Loads the most recently written live entries into the in-process
+        # tiers, which favours the users active just before the restart.
+        # Stops after max_entries or `budget` seconds.
+        caches = {cache.namespace: cache for cache in caches if isinstance(cache, TieredCache)}
+        if not caches:
+            return 0
+
+        started = time.monotonic()
+        loaded = 0
+        with pool.cursor() as cur:
+            cur.execute("SELECT namespace, key, value, EXTRACT(EPOCH FROM expires_at - now()) "
+                        "FROM cache_entries "
+                        "WHERE namespace = ANY(%s) AND expires_at > now() "
+                        "ORDER BY updated_at DESC "
+                        "LIMIT %s", (list(caches), max_entries))
+            while time.monotonic() - started < budget:
+                rows = cur.fetchmany(500)
+                if not rows:
+                    break
+                for namespace, key, value, ttl in rows:
+                    cache = caches[namespace]
+                    cache.l1.set(_load_key(key), cache.load(value), ttl=float(ttl))
+                loaded += len(rows)
+
+        with self._lock:
+            self._counters["warmed"] += loaded
+
+        return loaded
+
+    def stop(self):
+        # applies what is still queued
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["queued"] = self._queue.qsize()
+
+        return stats
+
+
+class TieredCache():
+    # A TTLCache (L1) in front of a namespace of the L2Store, with the same
+    # interface. L1 misses are looked up in L2 and copied back with their
+    # remaining TTL. Values are stored as JSON, `load` turns what comes back
+    # into the cached type again; change the namespace with the format.
+    # L2 misses are remembered for `miss_ttl` seconds.
+
+    def __init__(self, l1, namespace, store, load=None, miss_ttl=L2_MISS_TTL):
+        self.l1 = l1
+        self.namespace = namespace
+        self.store = store
+        self.load = load or (lambda value: value)
+
+        self._misses = TTLCache(maxsize=l1.maxsize, ttl=miss_ttl)
+        self._lock = threading.Lock()
+        self._counters = {"l2_hits": 0, "l2_misses": 0, "l2_known_misses": 0}
+
+    def get(self, key, default=None):
+        value = self.l1.get(key)
+        if value is not None:
+            return value
+
+        if self._misses.get(key):
+            with self._lock:
+                self._counters["l2_known_misses"] += 1
+            return default
+
+        found = self.store.get(self.namespace, _dump_key(key))
+        with self._lock:
+            self._counters["l2_hits" if found else "l2_misses"] += 1
+        if found is None:
+            self._misses.set(key, True)
+            return default
+
+        value, ttl = found
+        value = self.load(value)
+        self.l1.set(key, value, ttl=ttl)
+
+        return value
+
+    def get_stale(self, key, default=None):
+        value = self.l1.get_stale(key)
+        if value is not None:
+            return value
+
+        found = self.store.get(self.namespace, _dump_key(key), stale=True)
+        return default if found is None else self.load(found[0])
+
+    def set(self, key, value, ttl=None):
+        ttl = self.l1.ttl if ttl is None else ttl
+        self._misses.pop(key)
+        self.l1.set(key, value, ttl=ttl)
+        self.store.set(self.namespace, _dump_key(key), value, ttl)
+
+    def pop(self, key, default=None):
+        self.store.delete(self.namespace, _dump_key(key))
+        self._misses.pop(key)
+        return self.l1.pop(key, default)
+
+    def clear(self):
+        # the in-process tier only, like a restart
+        self.l1.clear()
+        self._misses.clear()
+
+    def keys(self):
+        return self.l1.keys()
+
+    def __len__(self):
+        return len(self.l1)
+
+    def stats(self):
+        stats = self.l1.stats()
+        with self._lock:
+            stats.update(self._counters)
+
+        return stats
+
+
+store = L2Store()
+
+
+def tiered(l1, namespace, load=None):
+    # `l1` on its own when the second tier is disabled
+    return TieredCache(l1, namespace, store, load) if L2_CACHE else l1
@@ -0,0 +1,135 @@
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+from rauth.session import OAuth1Session
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+
+from breaker import breaker
+from config import (BREAKER_SLOW_CALLS, HTTP_CONNECT_TIMEOUT, HTTP_DEADLINES,
+                    HTTP_POOL_BLOCK, HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE,
+                    HTTP_READ_TIMEOUT)
+from metrics import upstream_responses, upstream_seconds
+from ratelimit import scheduler
+
+ID_RE = re.compile(r"\d+")
+
+_local = threading.local()
+
+
+def endpoint(url):
+    # metric label for a request, "/book/show/:id.xml"
+    return "/" + ID_RE.sub(":id", urlsplit(url).path.lstrip("/"))
+
+
+def pool_wait():
+    # seconds this thread waited for a free pooled connection
+    return getattr(_local, 'pool_wait', 0.0)
+
+
+class TimedPool():
+    # adds the time spent waiting for a connection (HTTP_POOL_BLOCK) to
+    # pool_wait(), it is local contention, not goodreads.com being slow
+
+    def _get_conn(self, timeout=None):
+        started = time.perf_counter()
+        try:
+            return super()._get_conn(timeout)
+        finally:
+            _local.pool_wait = pool_wait() + time.perf_counter() - started
+
+
+class TimedHTTPConnectionPool(TimedPool, HTTPConnectionPool):
+    pass
+
+
+class TimedHTTPSConnectionPool(TimedPool, HTTPSConnectionPool):
+    pass
+
+
+class SharedHTTPAdapter(HTTPAdapter):
+    # One adapter (and so one urllib3 PoolManager) is mounted on every
+    # session, so keep-alive connections to goodreads.com are reused across
+    # users instead of each session opening its own.
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+    def stats(self):
+        pools = self.poolmanager.pools
+        connections = 0
+        hosts = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hosts += 1
+            connections += pool.num_connections
+
+        return {
+            "hosts": hosts,
+            "connections_opened": connections,
+            "pool_maxsize": self._pool_maxsize,
+        }
+
+
+adapter = SharedHTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                            pool_maxsize=HTTP_POOL_MAXSIZE,
+                            pool_block=HTTP_POOL_BLOCK)
+
+
+class GoodreadsSession(OAuth1Session):
+    # OAuth1 signing stays per session (per user), the connections
+    # underneath are shared through `adapter`.
+
+    timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+    # filled in by MyOAuth1Service.get_db_tokens_session
+    user_id = None
+    goodreads_id = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **req_kwargs):
+        name = endpoint(url)
+        # rauth falls back to a 300s timeout otherwise
+        req_kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_DEADLINES[name])
+                              if name in HTTP_DEADLINES else self.timeout)
+
+        breaker.before()
+        scheduler.acquire(user_id=self.user_id)
+
+        _local.pool_wait = 0.0
+        started = time.perf_counter()
+        try:
+            response = super().request(method, url, **req_kwargs)
+        except Exception as ex:
+            elapsed = time.perf_counter() - started
+            upstream_seconds.labels(method, name).observe(elapsed)
+            upstream_responses.labels(method, name, type(ex).__name__).inc()
+            breaker.record(elapsed - pool_wait(), failed=True)
+            raise
+
+        elapsed = time.perf_counter() - started
+        upstream_seconds.labels(method, name).observe(elapsed)
+        upstream_responses.labels(method, name, str(response.status_code)).inc()
+        # only the time goodreads.com took counts as a slow call
+        breaker.record(elapsed - pool_wait(),
+                       failed=response.status_code >= 500 or response.status_code == 429,
+                       slow_call=BREAKER_SLOW_CALLS.get(name))
+
+        return response
+
+    def close(self):
+        # Session.close() would close the shared adapter for everyone
+        pass
@@ -1,6 +1,7 @@
 import re
 
+TAGS = re.compile("<.*?>")
+
 
 def strip_tags(text):
-    clean = re.compile("<.*?>")
-    return re.sub(clean, "", text)
+    return TAGS.sub("", text)